@@ -0,0 +1,79 @@
+import sys
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from ingest import create_table_if_not_exists, iter_rows
+
+
+def make_household_income_frame(n_rows, seed=0):
+    # Synthetic frame shaped like a monthly household_income.csv
+    rng = np.random.default_rng(seed)
+    states = np.array(["Uttar Pradesh", "Madhya Pradesh", "Chhattisgarh", "Bihar"])
+    df = pd.DataFrame(
+        {
+            "HH_ID": rng.integers(10**9, 10**10, n_rows),
+            "STATE": states[rng.integers(0, len(states), n_rows)],
+            "DISTRICT": np.char.add(
+                "District ", rng.integers(0, 60, n_rows).astype(str)
+            ),
+            "REGION_TYPE": np.where(rng.random(n_rows) < 0.35, "URBAN", "RURAL"),
+            "STRATUM": rng.integers(1, 500, n_rows),
+            "PSU_ID": rng.integers(1, 5000, n_rows),
+            "HH_WGT_MS": rng.random(n_rows) * 1000,
+            "HH_WGT_FOR_STATE_MS": rng.random(n_rows) * 1000,
+            "TOT_INC": rng.random(n_rows) * 50000,
+        }
+    )
+    for source in ["WAGES", "PENSION", "DIVIDEND", "INTEREST", "FD_PF_INS"]:
+        df[f"INC_OF_ALL_MEMS_FRM_{source}"] = rng.random(n_rows) * 10000
+    for source in ["RENT", "SELF_PRODN", "PVT_TRF", "GOVT_TRF", "BIZ_PROFIT"]:
+        values = rng.random(n_rows) * 10000
+        values[rng.random(n_rows) < 0.1] = np.nan
+        df[f"INC_OF_HH_FRM_{source}"] = values
+    df["DIR_MONTH"] = "Apr"
+    df["DIR_YEAR"] = "2022"
+    return df
+
+
+def tuple_rows(df):
+    # The previous insert_data conversion
+    return [tuple(x) for x in df.to_numpy()]
+
+
+def time_insert(df, make_rows):
+    conn = sqlite3.connect(":memory:")
+    create_table_if_not_exists(
+        conn, "household_income", df, text_columns=("DIR_MONTH", "DIR_YEAR")
+    )
+    columns = ", ".join([f'"{col}"' for col in df.columns])
+    placeholders = ", ".join(["?" for _ in df.columns])
+    sql = f"INSERT INTO household_income ({columns}) VALUES ({placeholders})"
+
+    start = time.perf_counter()
+    conn.executemany(sql, make_rows(df))
+    conn.commit()
+    elapsed = time.perf_counter() - start
+
+    count = conn.execute("SELECT COUNT(*) FROM household_income").fetchone()[0]
+    conn.close()
+    assert count == len(df)
+    return elapsed
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    df = make_household_income_frame(n_rows)
+    print(f"Synthetic household_income frame: {n_rows} rows, {df.shape[1]} columns")
+
+    for name, make_rows in [
+        ("to_numpy tuples", tuple_rows),
+        ("column iterators", iter_rows),
+    ]:
+        elapsed = time_insert(df, make_rows)
+        print(f"{name:>18}: {elapsed:8.2f}s  {n_rows / elapsed:12,.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
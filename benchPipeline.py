@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import platform
+import numpy as np
+import pandas as pd
+from datetime import date
+
+import filterColumn
+from benchInsert import make_household_income_frame
+from filterStates import create_joined_table, dataset_join_configs
+from ingest import (
+    DATASETS,
+    DEFAULT_CHUNKSIZE,
+    create_database_connection,
+    finish_bulk_load,
+    ingest_dataset,
+)
+from mergeDBs import combine_databases
+from metrics import rss_sampler
+from rawCatalog import scan_raw_months
+
+STATES = ["Uttar Pradesh", "Madhya Pradesh", "Chhattisgarh", "Bihar", "Kerala"]
+
+# States kept by the join stage, as in filterStates
+JOIN_STATES = ["Uttar Pradesh", "Madhya Pradesh", "Chhattisgarh", "Bihar"]
+
+M_EXP_ITEMS = ["FOOD", "CEREALS", "MILK", "FUEL", "RENT", "EDUCATION", "HEALTH"]
+
+
+def month_dirs(n_months, first=date(2022, 4, 1)):
+    # "Apr 2022", "May 2022", ... as in the raw months tree
+    names = []
+    for i in range(n_months):
+        year, month = divmod(first.month - 1 + i, 12)
+        names.append(date(first.year + year, month + 1, 1).strftime("%b %Y"))
+    return names
+
+
+def household_panel(n_households, seed=0):
+    # The households every monthly file is drawn from, so the join matches
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "HH_ID": np.arange(n_households, dtype=np.int64) + 10**9,
+            "STATE": np.array(STATES)[rng.integers(0, len(STATES), n_households)],
+            "DISTRICT": np.char.add(
+                "District ", rng.integers(0, 60, n_households).astype(str)
+            ),
+            "REGION_TYPE": np.where(rng.random(n_households) < 0.35, "URBAN", "RURAL"),
+            "STRATUM": rng.integers(1, 500, n_households),
+            "PSU_ID": rng.integers(1, 5000, n_households),
+        }
+    )
+
+
+def make_month_frames(panel, seed):
+    # One synthetic frame per dataset for a month, with the CPHS column names
+    rng = np.random.default_rng(seed)
+    n_rows = len(panel)
+    keys = ["HH_ID", "STATE", "DISTRICT", "REGION_TYPE", "STRATUM", "PSU_ID"]
+
+    income = make_household_income_frame(n_rows, seed=seed)
+    income = income.drop(columns=["DIR_MONTH", "DIR_YEAR"])
+    for key in keys:
+        income[key] = panel[key].to_numpy()
+
+    people = panel[keys].copy()
+    people["GENDER"] = np.where(rng.random(n_rows) < 0.5, "M", "F")
+    people["AGE_YRS"] = rng.integers(0, 90, n_rows)
+    people["MEM_WGT_MS"] = rng.random(n_rows) * 1000
+
+    pyramids = panel[keys].copy()
+    pyramids["HH_WGT_MS"] = income["HH_WGT_MS"]
+    for item in M_EXP_ITEMS:
+        pyramids[f"M_EXP_{item}"] = rng.random(n_rows) * 5000
+    pyramids["TOT_EXP"] = pyramids[[f"M_EXP_{i}" for i in M_EXP_ITEMS]].sum(axis=1)
+
+    aspirational = panel[keys].copy()
+    aspirational["HH_WGT_MS"] = income["HH_WGT_MS"]
+    aspirational["CARS"] = rng.integers(0, 2, n_rows)
+    aspirational["BANK_ACCOUNT"] = np.where(rng.random(n_rows) < 0.8, "Y", "N")
+    aspirational["SAVING_STATUS"] = rng.integers(0, 3, n_rows)
+
+    return {
+        "household_income": income,
+        "people_of_india": people,
+        "consumption_pyramids": pyramids,
+        "aspirational_india": aspirational,
+    }
+
+
+def generate_raw_months(raw_dir, n_months, n_households, seed=0):
+    # Writes <raw_dir>/<Mon YYYY>/<dataset>.csv; returns rows written
+    panel = household_panel(n_households, seed)
+    rows = 0
+    for i, month_dir in enumerate(month_dirs(n_months)):
+        os.makedirs(os.path.join(raw_dir, month_dir), exist_ok=True)
+        for name, df in make_month_frames(panel, seed + i + 1).items():
+            df.to_csv(
+                os.path.join(raw_dir, month_dir, DATASETS[name]["csv"]), index=False
+            )
+            rows += len(df)
+    return rows
+
+
+def file_size_mb(*paths):
+    return round(
+        sum(os.path.getsize(p) for p in paths if os.path.exists(p)) / 1024**2, 2
+    )
+
+
+def count_rows(db_path, tables):
+    conn = sqlite3.connect(db_path)
+    try:
+        return sum(
+            conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            for table in tables
+        )
+    finally:
+        conn.close()
+
+
+def run_stage(results, name, func, output_dbs, output_tables):
+    # Time one stage and record rows/sec, peak RSS and output DB size. RSS
+    # is sampled while the stage runs, so each stage reports its own peak
+    # rather than the process's high-water mark so far.
+    print(f"=== {name} ===")
+    start = time.perf_counter()
+    with rss_sampler() as peaks:
+        func()
+    seconds = time.perf_counter() - start
+
+    rows = sum(count_rows(db, tables) for db, tables in zip(output_dbs, output_tables))
+    results.append(
+        {
+            "stage": name,
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "rows_per_sec": round(rows / seconds) if seconds else None,
+            "peak_rss_mb": peaks["peak_rss_mb"],
+            "peak_children_rss_mb": peaks["peak_children_rss_mb"],
+            "db_size_mb": file_size_mb(*output_dbs),
+        }
+    )
+
+
+def run_pipeline(work_dir, n_months, n_households, workers=None, seed=0):
+    raw_dir = os.path.join(work_dir, "raw months")
+    merged_db = os.path.join(work_dir, "ladli.db")
+    columns_db = os.path.join(work_dir, "filteredStatesAllColumns.db")
+    dataset_dbs = {
+        name: os.path.join(work_dir, dataset["db"])
+        for name, dataset in DATASETS.items()
+    }
+    results = []
+
+    print(f"Generating {n_months} months x {n_households} households...")
+    start = time.perf_counter()
+    csv_rows = generate_raw_months(raw_dir, n_months, n_households, seed)
+    generate_seconds = time.perf_counter() - start
+    csv_mb = file_size_mb(
+        *[os.path.join(d, f) for d, _, files in os.walk(raw_dir) for f in files]
+    )
+
+    def ingest():
+        catalog = scan_raw_months(raw_dir)
+        for name, dataset in DATASETS.items():
+            conn = create_database_connection(dataset_dbs[name], bulk_load=True)
+            ingest_dataset(
+                raw_dir,
+                conn,
+                dataset,
+                workers=workers,
+                chunksize=DEFAULT_CHUNKSIZE,
+                commit_every=None,
+                prescan=True,
+                catalog=catalog,
+            )
+            finish_bulk_load(conn)
+            conn.close()
+
+    def merge():
+        combine_databases(list(dataset_dbs.values()), merged_db, chunk_size=50000)
+
+    def join():
+        create_joined_table(
+            merged_db, "filteredStates", dataset_join_configs(), JOIN_STATES
+        )
+
+    def extract():
+        conn = sqlite3.connect(merged_db)
+        try:
+            columns = [
+                name
+                for name, _ in filterColumn.get_table_columns(conn, "filteredStates")
+            ]
+            filterColumn.extract_columns(
+                conn,
+                "filteredStates",
+                filterColumn.get_matching_columns(columns),
+                columns_db,
+            )
+        finally:
+            conn.close()
+
+    tables = [DATASETS[name]["table"] for name in dataset_dbs]
+    run_stage(
+        results,
+        "ingest",
+        ingest,
+        list(dataset_dbs.values()),
+        [[table] for table in tables],
+    )
+    run_stage(results, "merge", merge, [merged_db], [tables])
+    run_stage(results, "join", join, [merged_db], [["filteredStates"]])
+    run_stage(results, "columns", extract, [columns_db], [["filtered_table"]])
+
+    return {
+        "config": {
+            "months": n_months,
+            "households": n_households,
+            "workers": workers,
+            "seed": seed,
+        },
+        "generate": {
+            "seconds": round(generate_seconds, 3),
+            "rows": csv_rows,
+            "csv_size_mb": csv_mb,
+        },
+        "stages": results,
+        "environment": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "cpus": os.cpu_count(),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time ingest, merge, join and column extract on synthetic data"
+    )
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--households", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument(
+        "--work-dir", default=None, help="kept after the run; default is a temp dir"
+    )
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_pipeline_")
+    try:
+        report = run_pipeline(
+            work_dir, args.months, args.households, args.workers, args.seed
+        )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n{'stage':<8} {'seconds':>9} {'rows/sec':>12} {'peak MB':>9} {'DB MB':>9}")
+    for stage in report["stages"]:
+        print(
+            f"{stage['stage']:<8} {stage['seconds']:9.2f} "
+            f"{stage['rows_per_sec'] or 0:12,} {stage['peak_rss_mb'] or 0:9.1f} "
+            f"{stage['db_size_mb']:9.2f}"
+        )
+    print(f"Report written to '{args.output}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+import sys
+import math
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+from ingest import encoded_values
+from metrics import stage
+from weightedAgg import (
+    DEFAULT_CHUNK_SIZE,
+    dictionary_source,
+    filter_clause,
+    iter_sql_chunks,
+    quote,
+)
+
+# Treated states and the first treated PERIOD of each: Ladli Behna's first
+# transfer reached Madhya Pradesh in June 2023
+DEFAULT_TREATMENT = {"Madhya Pradesh": 202306}
+
+DEFAULT_OUTCOME = "TOT_INC"
+
+# Event-study leads and lags, in months; times beyond are binned into the
+# end points. -1 is the reference period.
+DEFAULT_WINDOW = (-12, 12)
+REFERENCE_PERIOD = -1
+
+# Alternating projections stop once no group mean exceeds TOLERANCE times
+# the column's standard deviation
+TOLERANCE = 1e-8
+MAX_ITERATIONS = 1000
+
+# Households and periods are absorbed as fixed effects; they are never
+# turned into dummy columns. The only dense matrix is n x (terms + 1).
+
+
+def month_index(period):
+    # yyyymm -> months since year 0, so differences are in months
+    period = np.asarray(period, dtype=np.int64)
+    return period // 100 * 12 + period % 100 - 1
+
+
+def load_panel(
+    conn,
+    table,
+    outcome,
+    weight=None,
+    states=None,
+    where=None,
+    hh_id="HH_ID",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    # Arrays of hh, period, state, y (and w) for rows with an outcome,
+    # fetched in chunks. STATE stays as stored (codes when encoded).
+    dict_source = dictionary_source(conn, table)
+    condition = f"{quote(outcome)} IS NOT NULL AND {quote(hh_id)} IS NOT NULL"
+    if where:
+        condition = f"{condition} AND ({where})"
+    clause, params = filter_clause(conn, dict_source, weight, states, condition)
+
+    columns = [hh_id, "PERIOD", "STATE", outcome] + ([weight] if weight else [])
+    parts = {name: [] for name in ["hh", "period", "state", "y", "w"]}
+    for df in iter_sql_chunks(conn, table, columns, clause, params, chunk_size):
+        parts["hh"].append(df[hh_id].to_numpy(dtype=np.int64))
+        parts["period"].append(df["PERIOD"].to_numpy(dtype=np.int64))
+        parts["state"].append(df["STATE"].to_numpy())
+        parts["y"].append(df[outcome].to_numpy(dtype=np.float64))
+        if weight:
+            parts["w"].append(df[weight].to_numpy(dtype=np.float64))
+
+    panel = {
+        name: np.concatenate(arrays) if arrays else np.array([])
+        for name, arrays in parts.items()
+    }
+    if not weight:
+        panel["w"] = None
+    return panel
+
+
+def take(panel, rows):
+    return {
+        name: None if values is None else values[rows] for name, values in panel.items()
+    }
+
+
+def collapse_household_months(panel):
+    # One observation per household-month. The join repeats household
+    # rows once per member, which would weight households by their size;
+    # y and w are averaged over the repeats, STATE is taken from the first.
+    keys = pd.MultiIndex.from_arrays([panel["hh"], panel["period"]])
+    ids, uniques = keys.factorize()
+    if len(uniques) == len(ids):
+        return panel
+    counts = np.bincount(ids)
+    first = np.empty(len(uniques), dtype=np.int64)
+    first[ids[::-1]] = np.arange(len(ids) - 1, -1, -1)
+    collapsed = take(panel, first)
+    collapsed["y"] = np.bincount(ids, weights=panel["y"]) / counts
+    if panel["w"] is not None:
+        collapsed["w"] = np.bincount(ids, weights=panel["w"]) / counts
+    return collapsed
+
+
+def drop_singletons(panel):
+    # Households seen in a single period are fitted exactly by their fixed
+    # effect and only inflate the degrees of freedom. Dropping some can
+    # leave a period with one household, so repeat until none is left.
+    while len(panel["hh"]):
+        hh_ids = pd.factorize(panel["hh"])[0]
+        period_ids = pd.factorize(panel["period"])[0]
+        keep = (np.bincount(hh_ids)[hh_ids] > 1) & (
+            np.bincount(period_ids)[period_ids] > 1
+        )
+        if keep.all():
+            break
+        panel = take(panel, keep)
+    return panel
+
+
+def treatment_start(conn, table, state, treatment):
+    # First treated month (month_index) of each row's state; -1 for rows
+    # of states never treated
+    dict_source = dictionary_source(conn, table)
+    start = np.full(len(state), -1, dtype=np.int64)
+    for name, first_period in treatment.items():
+        code = encoded_values(conn, dict_source, "STATE", [name])[0]
+        start[state == code] = month_index(first_period)
+    return start
+
+
+def demean(x, factors, weights=None, tol=TOLERANCE, max_iter=MAX_ITERATIONS):
+    # Residuals of the columns of x (n x k, modified in place) on the fixed
+    # effects in factors (integer group ids from 0), by alternating
+    # projections: each factor's weighted group means, from np.bincount,
+    # are subtracted in turn until none is left above tol.
+    if weights is None:
+        weights = np.ones(len(x))
+    group_weights = [np.bincount(ids, weights=weights) for ids in factors]
+    scale = np.maximum(x.std(axis=0), np.finfo(np.float64).tiny)
+
+    for iteration in range(1, max_iter + 1):
+        largest = 0.0
+        for ids, totals in zip(factors, group_weights):
+            for j in range(x.shape[1]):
+                means = np.bincount(
+                    ids, weights=weights * x[:, j], minlength=len(totals)
+                )
+                means /= np.where(totals > 0, totals, 1.0)
+                x[:, j] -= means[ids]
+                largest = max(largest, np.abs(means).max() / scale[j])
+        if largest < tol:
+            return x, iteration
+    print(f"Demeaning stopped after {max_iter} iterations (change {largest:.2e})")
+    return x, max_iter
+
+
+def nested_in(ids, clusters):
+    # True if every group of ids lies within one cluster, in which case its
+    # fixed effects use no degrees of freedom of the clustered errors
+    n = ids.max() + 1
+    low = np.full(n, np.iinfo(np.int64).max)
+    high = np.full(n, -1)
+    np.minimum.at(low, ids, clusters)
+    np.maximum.at(high, ids, clusters)
+    return bool(np.all(low == high))
+
+
+def fit(y, X, factors, clusters, weights=None, tol=TOLERANCE, max_iter=MAX_ITERATIONS):
+    # Weighted least squares of y on X with the fixed effects absorbed, and
+    # cluster-robust standard errors with the usual small-sample factor
+    # G/(G-1) * (N-1)/(N-K). K counts X plus the levels of fixed effects not
+    # nested in the clusters. Returns (coef, se, info).
+    data = np.column_stack([y, X])
+    data, iterations = demean(data, factors, weights, tol, max_iter)
+    y_tilde, X_tilde = data[:, 0], data[:, 1:]
+
+    w = np.ones(len(y)) if weights is None else weights
+    Xw = X_tilde * w[:, None]
+    bread = np.linalg.pinv(X_tilde.T @ Xw)
+    coef = bread @ (Xw.T @ y_tilde)
+    residuals = y_tilde - X_tilde @ coef
+
+    n_clusters = clusters.max() + 1
+    scores = Xw * residuals[:, None]
+    cluster_scores = np.column_stack(
+        [
+            np.bincount(clusters, weights=scores[:, j], minlength=n_clusters)
+            for j in range(scores.shape[1])
+        ]
+    )
+    # Each factor not nested in the clusters uses its levels - 1
+    absorbed = sum(ids.max() for ids in factors if not nested_in(ids, clusters))
+    n, k = X_tilde.shape
+    correction = n_clusters / (n_clusters - 1) * (n - 1) / (n - k - absorbed)
+    covariance = correction * bread @ (cluster_scores.T @ cluster_scores) @ bread
+    info = {
+        "n_obs": n,
+        "n_clusters": int(n_clusters),
+        "iterations": iterations,
+    }
+    return coef, np.sqrt(np.diag(covariance)), info
+
+
+def results_frame(terms, coef, se, info):
+    # Normal approximation for p-values and 95% intervals, which is poor
+    # with few clusters (e.g. clustering on STATE)
+    t = coef / np.where(se > 0, se, np.nan)
+    result = pd.DataFrame(
+        {
+            "term": terms,
+            "coef": coef,
+            "se": se,
+            "t": t,
+            "p_value": [math.erfc(abs(v) / math.sqrt(2)) for v in t],
+            "ci_low": coef - 1.96 * se,
+            "ci_high": coef + 1.96 * se,
+        }
+    )
+    result.attrs.update(info)
+    return result
+
+
+def prepare(
+    db_path, table, outcome, treatment, weight, states, where, hh_id, chunk_size
+):
+    conn = sqlite3.connect(db_path)
+    try:
+        panel = load_panel(
+            conn, table, outcome, weight, states, where, hh_id, chunk_size
+        )
+        rows = len(panel["hh"])
+        if weight:
+            panel = take(panel, panel["w"] > 0)
+        panel = drop_singletons(collapse_household_months(panel))
+        panel["start"] = treatment_start(conn, table, panel["state"], treatment)
+    finally:
+        conn.close()
+
+    if not len(panel["hh"]):
+        raise ValueError(f"No household-months of '{outcome}' in '{table}'")
+    if not (panel["start"] >= 0).any():
+        raise ValueError(f"No rows of the treated states {list(treatment)}")
+    print(
+        f"{rows} rows -> {len(panel['hh'])} household-months of "
+        f"{len(np.unique(panel['hh']))} households"
+    )
+    return rows, panel
+
+
+def factors_and_clusters(panel, cluster):
+    hh_ids = pd.factorize(panel["hh"])[0]
+    period_ids = pd.factorize(panel["period"])[0]
+    if cluster == "hh":
+        clusters = hh_ids
+    elif cluster == "state":
+        clusters = pd.factorize(panel["state"])[0]
+    else:
+        raise ValueError(f"cluster must be 'hh' or 'state', not {cluster!r}")
+    return [hh_ids, period_ids], clusters
+
+
+def did(
+    db_path,
+    table="filteredStates",
+    outcome=DEFAULT_OUTCOME,
+    treatment=DEFAULT_TREATMENT,
+    weight=None,
+    states=None,
+    where=None,
+    cluster="hh",
+    hh_id="HH_ID",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    # Two-way fixed effects difference-in-differences: outcome on
+    # treated-state x post-start, with household and period fixed effects.
+    # treatment maps state names to their first treated PERIOD.
+    with stage(f"did.{table}", outcome=outcome) as record:
+        record["rows"], panel = prepare(
+            db_path, table, outcome, treatment, weight, states, where, hh_id, chunk_size
+        )
+        treated = panel["start"] >= 0
+        post = month_index(panel["period"]) >= panel["start"]
+        X = (treated & post).astype(np.float64)[:, None]
+
+        factors, clusters = factors_and_clusters(panel, cluster)
+        coef, se, info = fit(panel["y"], X, factors, clusters, panel["w"])
+        info["n_households"] = int(factors[0].max() + 1)
+        info["treated_obs"] = int(X.sum())
+        record.update(info)
+    return results_frame(["treated_post"], coef, se, info)
+
+
+def event_study(
+    db_path,
+    table="filteredStates",
+    outcome=DEFAULT_OUTCOME,
+    treatment=DEFAULT_TREATMENT,
+    window=DEFAULT_WINDOW,
+    weight=None,
+    states=None,
+    where=None,
+    cluster="hh",
+    hh_id="HH_ID",
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    # Dynamic effects: one coefficient per month relative to the start for
+    # treated-state rows, within window (end points binned), relative to
+    # REFERENCE_PERIOD. Never-treated states are the comparison group.
+    first, last = window
+    with stage(f"event_study.{table}", outcome=outcome) as record:
+        record["rows"], panel = prepare(
+            db_path, table, outcome, treatment, weight, states, where, hh_id, chunk_size
+        )
+        treated = panel["start"] >= 0
+        relative = np.clip(month_index(panel["period"]) - panel["start"], first, last)
+        times = [
+            t
+            for t in range(first, last + 1)
+            if t != REFERENCE_PERIOD and (treated & (relative == t)).any()
+        ]
+        X = np.zeros((len(relative), len(times)))
+        for j, t in enumerate(times):
+            X[:, j] = treated & (relative == t)
+
+        factors, clusters = factors_and_clusters(panel, cluster)
+        coef, se, info = fit(panel["y"], X, factors, clusters, panel["w"])
+        info["n_households"] = int(factors[0].max() + 1)
+        info["treated_obs"] = int(treated.sum())
+        record.update(info)
+
+    result = results_frame([f"rel_{t}" for t in times], coef, se, info)
+    result.insert(1, "event_time", times)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Difference-in-differences and event-study estimates with "
+        "household and period fixed effects"
+    )
+    parser.add_argument("command", choices=["did", "event"])
+    parser.add_argument("--db", default="ladli.db")
+    parser.add_argument("--table", default="filteredStates")
+    parser.add_argument("--outcome", default=DEFAULT_OUTCOME)
+    parser.add_argument(
+        "--treated",
+        nargs="+",
+        default=[f"{s}={p}" for s, p in DEFAULT_TREATMENT.items()],
+        help="STATE=yyyymm of the first treated period",
+    )
+    parser.add_argument("--window", nargs=2, type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--weight", default=None, help="survey weight (default none)")
+    parser.add_argument("--states", nargs="*", default=None)
+    parser.add_argument("--where", default=None, help="extra SQL condition")
+    parser.add_argument("--cluster", choices=["hh", "state"], default="hh")
+    parser.add_argument("--output", default=None, help="CSV file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    treatment = {}
+    for item in args.treated:
+        state, _, period = item.rpartition("=")
+        treatment[state] = int(period)
+
+    options = dict(
+        table=args.table,
+        outcome=args.outcome,
+        treatment=treatment,
+        weight=args.weight,
+        states=args.states,
+        where=args.where,
+        cluster=args.cluster,
+    )
+    if args.command == "did":
+        result = did(args.db, **options)
+    else:
+        result = event_study(args.db, window=tuple(args.window), **options)
+
+    print(
+        f"{result.attrs['n_obs']} household-months, "
+        f"{result.attrs['n_clusters']} clusters, "
+        f"{result.attrs['iterations']} demeaning iterations"
+    )
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"{len(result)} estimates written to '{args.output}'")
+    else:
+        result.to_csv(sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()
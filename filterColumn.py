@@ -1,21 +1,29 @@
-import sqlite3
-import pandas as pd
 import re
+import sys
+import sqlite3
+import argparse
 from tqdm import tqdm
 
-# Connect to the original SQLite database
-original_db = "ladli.db"  # Replace with your original DB path
-conn = sqlite3.connect(original_db)
-
-# Fetch the table schema to get all column names
-query = "PRAGMA table_info(filteredStates);"  # Replace 'your_table_name' with the actual table name
-columns_info = pd.read_sql_query(query, conn)
+from ingest import copy_dictionaries, create_decoded_view, dictionary_source
+from metrics import sql_timer, stage
 
-# Extract the column names
-columns = columns_info["name"].tolist()
+# Columns kept regardless of the patterns below
+BASE_COLUMNS = [
+    "WAVE_NO",
+    "HH_ID",
+    "month",
+    "year",
+    "PERIOD",
+    "STATE",
+    "DISTRICT",
+    "REGION_TYPE",
+    "GENDER",
+    "AGE_YRS",
+    # "R_MEM_WGT_FOR_STATE_MS",
+]
 
 # Define the patterns you want to match
-patterns = [
+PATTERNS = [
     "M_EXP",
     "ADJ_",
     "TS_",
@@ -31,61 +39,132 @@ patterns = [
     "BANK",
 ]
 
-# Filter the columns that match any of the patterns
-matching_columns = [
-    "WAVE_NO",
-    "HH_ID",
-    "month",
-    "year",
-    "STATE",
-    "DISTRICT",
-    "REGION_TYPE",
-    "GENDER",
-    "AGE_YRS",
-    # "R_MEM_WGT_FOR_STATE_MS",
-]
 
-matching_columns += [
-    col
-    for col in columns
-    if any(re.search(f"^{pattern}|{pattern}", col) for pattern in patterns)
-]
+def get_table_columns(conn, table):
+    # (name, declared type) for every column of the table
+    return [(row[1], row[2]) for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def get_matching_columns(columns, base_columns=BASE_COLUMNS, patterns=PATTERNS):
+    # Filter the columns that match any of the patterns, keeping the base
+    # columns first and each column once
+    missing = [col for col in base_columns if col not in columns]
+    if missing:
+        print(f"Base columns not in table, skipped: {', '.join(missing)}")
+
+    matching_columns = [col for col in base_columns if col in columns]
+    matching_columns += [
+        col
+        for col in columns
+        if any(re.search(f"^{pattern}|{pattern}", col) for pattern in patterns)
+    ]
+    return list(dict.fromkeys(matching_columns))
+
+
+def extract_columns(
+    conn, table, columns, new_db, new_table="filtered_table", chunk_size=100000
+):
+    # Select only the wanted columns and copy them cursor to cursor in
+    # fetchmany batches, without building DataFrames in between.
+    # Dictionary-encoded columns are copied as codes together with their
+    # lookup tables, and <new_table>_decoded is created as in the source.
+    types = dict(get_table_columns(conn, table))
+    column_names = ", ".join([f'"{col}"' for col in columns])
+    placeholders = ", ".join(["?" for _ in columns])
+
+    # Get the total number of rows for the progress bar
+    total_rows = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    print(f"Total rows: {total_rows}")
+
+    with stage(
+        f"columns.{new_table}", outputs=[new_db], columns=len(columns)
+    ) as record:
+        conn_new = sqlite3.connect(new_db)
+        try:
+            column_definitions = ", ".join([f'"{col}" {types[col]}' for col in columns])
+            conn_new.execute(
+                f'CREATE TABLE IF NOT EXISTS "{new_table}" ({column_definitions})'
+            )
+            insert_sql = (
+                f'INSERT INTO "{new_table}" ({column_names}) VALUES ({placeholders})'
+            )
+
+            cursor = conn.cursor()
+            cursor.arraysize = chunk_size
+            cursor.execute(f'SELECT {column_names} FROM "{table}"')
+
+            # Write batches to the new database incrementally with progress bar
+            with tqdm(total=total_rows, desc="Processing rows") as pbar:
+                while True:
+                    with sql_timer(record, "select"):
+                        rows = cursor.fetchmany()
+                    if not rows:
+                        break
+                    with sql_timer(record, "insert"):
+                        conn_new.executemany(insert_sql, rows)
+                    pbar.update(len(rows))
+                record["rows"] = pbar.n
+
+            dict_source = dictionary_source(conn, table)
+            if copy_dictionaries(conn, conn_new, dict_source, columns):
+                create_decoded_view(conn_new, new_table, dict_source=dict_source)
+
+            with sql_timer(record, "commit"):
+                conn_new.commit()
+        finally:
+            conn_new.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Copy the pattern-matched columns of a table to a new database"
+    )
+    parser.add_argument("--db", default="ladli.db", help="source database")
+    parser.add_argument("--table", default="filteredStates", help="source table")
+    parser.add_argument(
+        "--output", default="filteredStatesAllColumns.db", help="new database"
+    )
+    parser.add_argument("--output-table", default="filtered_table")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--all-columns", action="store_true", help="copy every column")
+    parser.add_argument(
+        "-y", "--yes", action="store_true", help="do not pause before copying"
+    )
+    args = parser.parse_args(argv)
 
-# If no columns matched, raise an error
-if not matching_columns:
-    raise ValueError("No columns matching the patterns found!")
+    # Connect to the original SQLite database
+    conn = sqlite3.connect(args.db)
 
-# print("Matched columns:")
-# print(matching_columns)
-print(columns)
-input("Press Enter to continue...")
+    # Fetch the table schema to get all column names
+    columns = [name for name, _ in get_table_columns(conn, args.table)]
+    if args.all_columns:
+        matching_columns = columns
+    else:
+        matching_columns = get_matching_columns(columns)
 
-# Create the SQL query to select only the necessary columns
-selected_columns = ", ".join(matching_columns)
-select_query = f"SELECT * FROM filteredStates;"  # Replace with your table name
+    # If no columns matched, raise an error
+    if not matching_columns:
+        raise ValueError("No columns matching the patterns found!")
 
-# Get the total number of rows for the progress bar
-total_rows = pd.read_sql_query("SELECT COUNT(*) FROM filteredStates", conn).iloc[0, 0]
-print(f"Total rows: {total_rows}")
+    print(f"Selected {len(matching_columns)} of {len(columns)} columns:")
+    print(matching_columns)
+    if not args.yes and sys.stdin.isatty():
+        input("Press Enter to continue...")
 
-# Stream data in chunks instead of loading everything at once (use chunksize for large tables)
-chunk_size = 100000  # Adjust the chunk size based on memory limits
-chunk_iter = pd.read_sql_query(select_query, conn, chunksize=chunk_size)
+    extract_columns(
+        conn,
+        args.table,
+        matching_columns,
+        args.output,
+        args.output_table,
+        args.chunk_size,
+    )
 
-# Connect to the new SQLite database
-new_db = (
-    "filteredStatesAllColumns.db"  # Replace with the path to the new SQLite database
-)
-conn_new = sqlite3.connect(new_db)
+    # Close the database connection
+    conn.close()
 
-# Write chunks to the new database incrementally with progress bar
-with tqdm(total=total_rows, desc="Processing rows") as pbar:
-    for chunk in chunk_iter:
-        chunk.to_sql("filtered_table", conn_new, if_exists="append", index=False)
-        pbar.update(len(chunk))
+    print("Data successfully extracted and written to the new database!")
 
-# Close both database connections
-conn.close()
-conn_new.close()
 
-print("Data successfully extracted and written to the new database!")
+if __name__ == "__main__":
+    main()
@@ -1,108 +1,427 @@
+import time
 import sqlite3
 from tqdm import tqdm
+from datetime import datetime
 
+from metrics import stage
 
-def create_joined_table(db_path, new_table_name, table_configs, state_values):
+from ingest import (
+    DATASETS,
+    add_period_column,
+    create_decoded_view,
+    encoded_columns,
+    encoded_values,
+    table_exists,
+)
+
+# High-water marks of incrementally refreshed joined tables
+WATERMARK_TABLE = "_join_watermarks"
+
+# Upper bound for open-ended period ranges
+LAST_PERIOD = 999912
+
+# Join order of the ingested datasets; the first is the base table
+JOIN_DATASETS = [
+    "people_of_india",
+    "household_income",
+    "consumption_pyramids",
+    "aspirational_india",
+]
+
+
+def dataset_join_configs(names=JOIN_DATASETS, hh_id="HH_ID", state="STATE"):
+    # Table configs for ingested datasets, joined on (HH_ID, PERIOD), with
+    # the states filtered on the first one
+    configs = []
+    for i, name in enumerate(names):
+        dataset = DATASETS[name]
+        config = {
+            "name": dataset["table"],
+            "hh_id": hh_id,
+            "month": dataset["month"],
+            "year": dataset["year"],
+            "period": "PERIOD",
+        }
+        if i == 0:
+            config["state"] = state
+        configs.append(config)
+    return configs
+
+
+def has_index(cursor, table, columns):
+    # True if some index on the table starts with exactly these columns
+    for index in cursor.execute(f"PRAGMA index_list({table})").fetchall():
+        index_columns = [
+            row[2] for row in cursor.execute(f"PRAGMA index_info('{index[1]}')")
+        ]
+        if [c.lower() for c in index_columns[: len(columns)]] == [
+            c.lower() for c in columns
+        ]:
+            return True
+    return False
+
+
+def uses_period(table_configs):
+    return all(config.get("period") for config in table_configs)
+
+
+def join_keys(config, period=True):
+    # (HH_ID, PERIOD) when the integer period key is configured, otherwise
+    # the text (HH_ID, month, year) columns
+    if period and config.get("period"):
+        return [config["hh_id"], config["period"]]
+    return [config["hh_id"], config["month"], config["year"]]
+
+
+def ensure_join_indexes(cursor, table_configs):
+    # Index the join keys of every table and STATE wherever it exists, so
+    # SQLite does not build automatic indexes or fall back to nested scans
+    # on every run
+    period = uses_period(table_configs)
+    created = []
+    for config in table_configs:
+        table = config["name"]
+        if period:
+            add_period_column(cursor.connection, table, config["month"], config["year"])
+        existing = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+        wanted = [join_keys(config, period)]
+        state = config.get("state", "STATE")
+        if state in existing:
+            # (STATE, PERIOD) also serves STATE-only filters, and lets the
+            # partitioned join and period refreshes seek to one month
+            wanted.append([state, config["period"]] if period else [state])
+
+        for columns in wanted:
+            index_name = f"idx_{table}_{'_'.join(columns)}"
+            if not has_index(cursor, table, columns):
+                print(f"Creating index {index_name} on {table} ({', '.join(columns)})")
+                cursor.execute(
+                    f"CREATE INDEX IF NOT EXISTS {index_name} "
+                    f"ON {table} ({', '.join(columns)})"
+                )
+                created.append(index_name)
+    return created
+
+
+def check_query_plan(cursor, select_query, params, base_table):
+    # Print the plan and warn about anything that is not an index lookup
+    # on the joined tables
+    plan = cursor.execute(f"EXPLAIN QUERY PLAN {select_query}", params).fetchall()
+    print("Query plan:")
+    problems = []
+    for row in plan:
+        detail = row[-1]
+        print(f"  {detail}")
+        scans_joined_table = detail.startswith("SCAN") and not detail.startswith(
+            f"SCAN {base_table}"
+        )
+        if "AUTOMATIC" in detail or scans_joined_table:
+            problems.append(detail)
+
+    if problems:
+        print("Warning: join is not fully index-driven:")
+        for detail in problems:
+            print(f"  {detail}")
+    return plan
+
+
+def state_parameters(conn, table_configs, state_values):
+    # State names, or their codes when the base table's STATE is encoded
+    base = table_configs[0]
+    return encoded_values(conn, base["name"], base["state"], state_values)
+
+
+def build_join_query(table_configs, state_values, periods=None):
+    # Construct the JOIN query. periods is an optional inclusive
+    # (first, last) yyyymm range, only usable when PERIOD is configured.
+    period = uses_period(table_configs)
+    base_keys = join_keys(table_configs[0], period)
+    select_clauses = []
+    join_clauses = []
+    for i, config in enumerate(table_configs):
+        table = config["name"]
+
+        if i == 0:
+            select_clauses.append(f"SELECT * FROM {table}")
+            base_table = table
+        else:
+            conditions = [
+                f"{base_table}.{base_key} = {table}.{key}"
+                for base_key, key in zip(base_keys, join_keys(config, period))
+            ]
+            join_clauses.append(f"""
+                JOIN {table}
+                ON {' AND '.join(conditions)}
+            """)
+
+    # Use placeholders for state values
+    state_placeholders = ",".join(["?" for _ in state_values])
+    state_condition = (
+        f"WHERE {base_table}.{table_configs[0]['state']} IN ({state_placeholders})"
+    )
+    if periods is not None:
+        if not period:
+            raise ValueError("A period range needs a 'period' column in every config")
+        state_condition += (
+            f" AND {base_table}.{table_configs[0]['period']} BETWEEN {int(periods[0])}"
+            f" AND {int(periods[1])}"
+        )
+
+    return f"""
+    {select_clauses[0]}
+    {' '.join(join_clauses)}
+    {state_condition}
+    """
+
+
+def create_joined_table(
+    db_path, new_table_name, table_configs, state_values, periods=None
+):
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
+    timings = {}
 
-    try:
-        # Start a transaction
-        conn.execute("BEGIN TRANSACTION")
-
-        # Construct the JOIN query
-        select_clauses = []
-        join_clauses = []
-        for i, config in enumerate(table_configs):
-            table = config["name"]
-            hh_id = config["hh_id"]
-            month = config["month"]
-            year = config["year"]
-            state = config.get("state", "STATE")  # Default to 'STATE' if not specified
-
-            if i == 0:
-                select_clauses.append(f"SELECT * FROM {table}")
-                base_table = table
-            else:
-                join_clauses.append(f"""
-                    JOIN {table}
-                    ON {base_table}.{table_configs[0]['hh_id']} = {table}.{hh_id}
-                    AND {base_table}.{table_configs[0]['month']} = {table}.{month}
-                    AND {base_table}.{table_configs[0]['year']} = {table}.{year}
-                """)
-
-        # Use placeholders for state values
-        state_placeholders = ",".join(["?" for _ in state_values])
-        state_condition = (
-            f"WHERE {base_table}.{table_configs[0]['state']} IN ({state_placeholders})"
-        )
+    with stage(f"join.{new_table_name}", outputs=[db_path]) as record:
+        try:
+            # Indexes are committed on their own so they survive a failed join
+            start = time.perf_counter()
+            ensure_join_indexes(cursor, table_configs)
+            conn.commit()
+            timings["indexes"] = time.perf_counter() - start
 
-        query = f"""
-        CREATE TABLE {new_table_name} AS
-        {select_clauses[0]}
-        {' '.join(join_clauses)}
-        {state_condition}
-        """
+            select_query = build_join_query(table_configs, state_values, periods)
+            state_params = state_parameters(conn, table_configs, state_values)
 
-        print(f"Creating new table '{new_table_name}'...")
-        print("Executing query:", query)  # Print the query for debugging
-        print("State values:", state_values)  # Print state values for verification
-        cursor.execute(query, state_values)
+            start = time.perf_counter()
+            check_query_plan(
+                cursor, select_query, state_params, table_configs[0]["name"]
+            )
+            timings["plan"] = time.perf_counter() - start
 
-        # Get the number of rows inserted
-        cursor.execute(f"SELECT COUNT(*) FROM {new_table_name}")
-        row_count = cursor.fetchone()[0]
+            # Start a transaction
+            conn.execute("BEGIN TRANSACTION")
 
-        # Commit the transaction
-        conn.commit()
-        print(f"Successfully created table '{new_table_name}' with {row_count} rows")
+            query = f"""
+            CREATE TABLE {new_table_name} AS
+            {select_query}
+            """
 
-    except Exception as e:
-        conn.rollback()
-        print(f"An error occurred: {e}")
+            print(f"Creating new table '{new_table_name}'...")
+            print("Executing query:", query)  # Print the query for debugging
+            print("State values:", state_values)  # Print state values for verification
+            start = time.perf_counter()
+            cursor.execute(query, state_params)
+            timings["join"] = time.perf_counter() - start
 
-    finally:
+            # Get the number of rows inserted
+            start = time.perf_counter()
+            cursor.execute(f"SELECT COUNT(*) FROM {new_table_name}")
+            row_count = cursor.fetchone()[0]
+            timings["count"] = time.perf_counter() - start
+
+            # Commit the transaction
+            start = time.perf_counter()
+            conn.commit()
+            timings["commit"] = time.perf_counter() - start
+            record["rows"] = row_count
+            print(
+                f"Successfully created table '{new_table_name}' with {row_count} rows"
+            )
+
+            # Decode the base table's dictionary-encoded columns, if any
+            if encoded_columns(conn, table_configs[0]["name"]):
+                create_decoded_view(
+                    conn, new_table_name, dict_source=table_configs[0]["name"]
+                )
+                conn.commit()
+
+        except Exception as e:
+            conn.rollback()
+            record["error"] = repr(e)
+            print(f"An error occurred: {e}")
+
+        finally:
+            conn.close()
+            record["timings"] = {name: round(t, 3) for name, t in timings.items()}
+            print("Timing breakdown:")
+            for name, seconds in timings.items():
+                print(f"  {name:<8} {seconds:10.2f}s")
+    return record
+
+
+def get_watermark(cursor, table_name):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        table_name TEXT PRIMARY KEY,
+        period INTEGER,
+        refreshed_at TEXT
+    )
+    """)
+    row = cursor.execute(
+        f"SELECT period FROM {WATERMARK_TABLE} WHERE table_name = ?", (table_name,)
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    # Table built before watermarks were tracked
+    return cursor.execute(f"SELECT MAX(PERIOD) FROM {table_name}").fetchone()[0]
+
+
+def set_watermark(cursor, table_name, period):
+    cursor.execute(
+        f"INSERT OR REPLACE INTO {WATERMARK_TABLE} VALUES (?, ?, ?)",
+        (table_name, period, datetime.now().isoformat(timespec="seconds")),
+    )
+
+
+def refresh_joined_table(db_path, table_name, table_configs, state_values, since=None):
+    # Append only the joined rows for periods after the table's high-water
+    # mark. since=<yyyymm> first deletes and rebuilds everything from that
+    # period on, e.g. after a past month was re-delivered. Creates the
+    # table in full if it does not exist yet. Errors are printed rather
+    # than raised; the returned stage record has "error" set.
+    if not uses_period(table_configs):
+        raise ValueError("Incremental refresh needs a 'period' column in every config")
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    exists = table_exists(conn, table_name)
+    conn.close()
+
+    if not exists:
+        record = create_joined_table(db_path, table_name, table_configs, state_values)
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        if table_exists(conn, table_name):
+            get_watermark(cursor, table_name)
+            period = cursor.execute(f"SELECT MAX(PERIOD) FROM {table_name}").fetchone()
+            set_watermark(cursor, table_name, period[0])
+            conn.commit()
         conn.close()
+        return record
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    timings = {}
 
+    with stage(f"refresh.{table_name}", outputs=[db_path]) as record:
+        try:
+            start = time.perf_counter()
+            ensure_join_indexes(cursor, table_configs)
+            if not has_index(cursor, table_name, ["PERIOD"]):
+                cursor.execute(
+                    f"CREATE INDEX idx_{table_name}_PERIOD ON {table_name} (PERIOD)"
+                )
+            conn.commit()
+            timings["indexes"] = time.perf_counter() - start
 
-# Example usage
-db_path = "ladli.db"
-new_table_name = "filteredStates"
-
-table_configs = [
-    {
-        "name": "people_of_india",
-        "hh_id": "HH_ID",
-        "month": "month",
-        "year": "year",
-        "state": "STATE",
-    },
-    {
-        "name": "household_income",
-        "hh_id": "HH_ID",
-        "month": "DIR_MONTH",
-        "year": "DIR_YEAR",
-    },
-    {
-        "name": "consumption_pyramids",
-        "hh_id": "HH_ID",
-        "month": "DIR_MONTH",
-        "year": "DIR_YEAR",
-    },
-    {
-        "name": "aspirational_india",
-        "hh_id": "HH_ID",
-        "month": "month",
-        "year": "year",
-    },
-]
+            watermark = get_watermark(cursor, table_name) or 0
+            if since is not None:
+                watermark = min(watermark, int(since) - 1)
+            select_query = build_join_query(
+                table_configs, state_values, (watermark + 1, LAST_PERIOD)
+            )
+            state_params = state_parameters(conn, table_configs, state_values)
 
-state_values = [
-    "Uttar Pradesh",
-    "Madhya Pradesh",
-    "Chhattisgarh",
-    "Jharkhand",
-    "Bihar",
-]
+            # Positional INSERT ... SELECT * only works while the layout matches
+            new_width = len(
+                cursor.execute(f"{select_query} LIMIT 0", state_params).description
+            )
+            old_width = len(
+                cursor.execute(f"PRAGMA table_info({table_name})").fetchall()
+            )
+            if new_width != old_width:
+                raise ValueError(
+                    f"Joined query has {new_width} columns but '{table_name}' has "
+                    f"{old_width}; the source schema changed, rebuild the table"
+                )
+
+            conn.execute("BEGIN TRANSACTION")
+
+            start = time.perf_counter()
+            cursor.execute(f"DELETE FROM {table_name} WHERE PERIOD > ?", (watermark,))
+            removed = cursor.rowcount
+            timings["delete"] = time.perf_counter() - start
+
+            print(f"Appending periods after {watermark} to '{table_name}'...")
+            start = time.perf_counter()
+            cursor.execute(f"INSERT INTO {table_name} {select_query}", state_params)
+            added = cursor.rowcount
+            timings["join"] = time.perf_counter() - start
+
+            period = cursor.execute(f"SELECT MAX(PERIOD) FROM {table_name}").fetchone()[
+                0
+            ]
+            set_watermark(cursor, table_name, period)
+
+            start = time.perf_counter()
+            conn.commit()
+            timings["commit"] = time.perf_counter() - start
+            if removed:
+                print(f"Removed {removed} rows from periods being rebuilt")
+            record["rows"] = added
+            record["watermark"] = period
+            print(
+                f"Added {added} rows to '{table_name}'; high-water mark is now {period}"
+            )
+
+        except Exception as e:
+            conn.rollback()
+            record["error"] = repr(e)
+            print(f"An error occurred: {e}")
+
+        finally:
+            conn.close()
+            record["timings"] = {name: round(t, 3) for name, t in timings.items()}
+            print("Timing breakdown:")
+            for name, seconds in timings.items():
+                print(f"  {name:<8} {seconds:10.2f}s")
+    return record
+
+
+if __name__ == "__main__":
+    # Example usage
+    db_path = "ladli.db"
+    new_table_name = "filteredStates"
+
+    table_configs = [
+        {
+            "name": "people_of_india",
+            "hh_id": "HH_ID",
+            "month": "month",
+            "year": "year",
+            "period": "PERIOD",
+            "state": "STATE",
+        },
+        {
+            "name": "household_income",
+            "hh_id": "HH_ID",
+            "month": "DIR_MONTH",
+            "year": "DIR_YEAR",
+            "period": "PERIOD",
+        },
+        {
+            "name": "consumption_pyramids",
+            "hh_id": "HH_ID",
+            "month": "DIR_MONTH",
+            "year": "DIR_YEAR",
+            "period": "PERIOD",
+        },
+        {
+            "name": "aspirational_india",
+            "hh_id": "HH_ID",
+            "month": "month",
+            "year": "year",
+            "period": "PERIOD",
+        },
+    ]
+
+    state_values = [
+        "Uttar Pradesh",
+        "Madhya Pradesh",
+        "Chhattisgarh",
+        "Jharkhand",
+        "Bihar",
+    ]
 
-create_joined_table(db_path, new_table_name, table_configs, state_values)
+    refresh_joined_table(db_path, new_table_name, table_configs, state_values)
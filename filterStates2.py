@@ -1,72 +1,113 @@
+import os
+import shutil
 import sqlite3
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+from filterStates import (
+    build_join_query,
+    ensure_join_indexes,
+    join_keys,
+    state_parameters,
+    uses_period,
+)
+from ingest import table_exists
+
+
+def build_aliased_query(cursor, table_configs):
+    # SELECT ... FROM ... JOIN ... with every column aliased as
+    # <table>_<column>; returns the query and the base table's join keys
+    period = uses_period(table_configs)
+    base_keys = join_keys(table_configs[0], period)
+    columns = []
+    join_clauses = []
+    for i, config in enumerate(table_configs):
+        table = config["name"]
+
+        # Create alias for each column to avoid conflicts
+        columns += [
+            f"t{i}.{col[1]} AS {table}_{col[1]}"
+            for col in cursor.execute(f"PRAGMA table_info({table})").fetchall()
+        ]
+
+        if i > 0:
+            conditions = [
+                f"t0.{base_key} = t{i}.{key}"
+                for base_key, key in zip(base_keys, join_keys(config, period))
+            ]
+            join_clauses.append(f"""
+                JOIN {table} t{i}
+                ON {' AND '.join(conditions)}
+            """)
+
+    query = f"""
+    SELECT {', '.join(columns)} FROM {table_configs[0]['name']} t0
+    {' '.join(join_clauses)}
+    """
+    return query, base_keys
+
+
+def check_width(cursor, join_query, table_configs, state_values):
+    # The aliased query must return every column the serial join does
+    params = state_parameters(cursor.connection, table_configs, state_values)
+    serial = build_join_query(table_configs, state_values)
+    expected = len(cursor.execute(f"{serial} LIMIT 0", params).description)
+    width = len(cursor.execute(f"{join_query} LIMIT 0").description)
+    if width != expected:
+        raise ValueError(
+            f"Aliased join has {width} columns but the serial join has {expected}"
+        )
+
+
+def create_key_index(cursor, table_name, base, base_keys):
+    # Not unique: the base table can hold several rows per key, e.g. one
+    # per household member in people_of_india
+    key_cols = [f"{base['name']}_{col}" for col in base_keys]
+    cursor.execute(f"""
+        CREATE INDEX idx_{table_name}_keys
+        ON {table_name} ({', '.join(key_cols)})
+    """)
+    return key_cols
+
 
 def create_joined_table(db_path, new_table_name, table_configs, state_values):
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
     try:
+        # Make sure the join keys are indexed before building the table
+        ensure_join_indexes(cursor, table_configs)
+        conn.commit()
+
         # Start a transaction
         conn.execute("BEGIN TRANSACTION")
 
-        # Construct the JOIN query
-        select_clauses = []
-        join_clauses = []
-        for i, config in enumerate(table_configs):
-            table = config["name"]
-            hh_id = config["hh_id"]
-            month = config["month"]
-            year = config["year"]
-            state = config.get("state", "state")  # Default to 'state' if not specified
-
-            # Create alias for each column to avoid conflicts
-            columns = [
-                f"t{i}.{col} AS {table}_{col}"
-                for col in cursor.execute(f"PRAGMA table_info({table})").fetchall()
-            ]
-            select_clauses.append(f"SELECT {', '.join(columns)} FROM {table} t{i}")
-
-            if i > 0:
-                join_clauses.append(f"""
-                    JOIN {table} t{i}
-                    ON t0.{table_configs[0]['hh_id']} = t{i}.{hh_id}
-                    AND t0.{table_configs[0]['month']} = t{i}.{month}
-                    AND t0.{table_configs[0]['year']} = t{i}.{year}
-                """)
+        # Construct the JOIN query, keyed on (HH_ID, PERIOD) when configured
+        join_query, base_keys = build_aliased_query(cursor, table_configs)
 
         state_condition = f"WHERE t0.{table_configs[0]['state']} IN ({','.join(['?']*len(state_values))})"
 
         query = f"""
         CREATE TABLE {new_table_name} AS
-        {select_clauses[0]}
-        {' '.join(join_clauses)}
+        {join_query}
         {state_condition}
         """
 
         print(f"Creating new table '{new_table_name}'...")
         print("Executing query:", query)  # Print the query for debugging
-        cursor.execute(query, state_values)
+        cursor.execute(query, state_parameters(conn, table_configs, state_values))
 
         # Get the number of rows inserted
         cursor.execute(f"SELECT COUNT(*) FROM {new_table_name}")
         row_count = cursor.fetchone()[0]
 
-        # Create the composite primary key
-        primary_key_cols = [
-            f"{table_configs[0]['name']}_{col}" for col in ["hh_id", "month", "year"]
-        ]
-        cursor.execute(f"""
-            CREATE UNIQUE INDEX idx_{new_table_name}_pk 
-            ON {new_table_name} ({', '.join(primary_key_cols)})
-        """)
+        key_cols = create_key_index(cursor, new_table_name, table_configs[0], base_keys)
 
         # Commit the transaction
         conn.commit()
         print(f"Successfully created table '{new_table_name}' with {row_count} rows")
-        print(
-            f"Added composite primary key ({', '.join(primary_key_cols)}) to {new_table_name}"
-        )
+        print(f"Added index on ({', '.join(key_cols)}) to {new_table_name}")
 
     except Exception as e:
         conn.rollback()
@@ -76,49 +117,157 @@ def create_joined_table(db_path, new_table_name, table_configs, state_values):
         conn.close()
 
 
-# Example usage
-db_path = "ladli.db"
-new_table_name = "filteredStates"
-
-# Configure your tables here
-table_configs = [
-    {
-        "name": "people_of_india",
-        "hh_id": "HH_ID",
-        "month": "month",
-        "year": "year",
-        "state": "STATE",
-    },
-    {
-        "name": "household_income",
-        "hh_id": "HH_ID",
-        "month": "DIR_MONTH",
-        "year": "DIR_YEAR",
-        "state": "STATE",
-    },
-    {
-        "name": "consumption_pyramids",
-        "hh_id": "HH_ID",
-        "month": "DIR_MONTH",
-        "year": "DIR_YEAR",
-        "state": "STATE",
-    },
-    {
-        "name": "aspirational_india",
-        "hh_id": "HH_ID",
-        "month": "month",
-        "year": "year",
-        "state": "STATE",
-    },
-    # Add more table configurations as needed
-]
-
-state_values = [
-    "Uttar Pradesh",
-    "Madhya Pradesh",
-    "Chhattisgarh",
-    "Jharkhand",
-    "Bihar",
-]  # Add the four allowed state values here
-
-create_joined_table(db_path, new_table_name, table_configs, state_values)
+def join_partition(db_path, join_query, where, params, shard_path):
+    # Runs in a worker process: joins one (STATE, PERIOD) slice from a
+    # read-only connection into its own shard database
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        conn.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+        conn.execute(f"CREATE TABLE shard.part AS {join_query} {where}", params)
+        conn.commit()
+        rows = conn.execute("SELECT COUNT(*) FROM shard.part").fetchone()[0]
+    finally:
+        conn.close()
+    return shard_path, rows
+
+
+def create_joined_table_partitioned(
+    db_path, new_table_name, table_configs, state_values, workers=None, shard_dir=None
+):
+    # Same table as create_joined_table, but the join is split into one
+    # task per (STATE, PERIOD) run on a process pool. Shards are written to
+    # temporary databases and concatenated into the final table, which is
+    # built under a temporary name and renamed once complete.
+    if not uses_period(table_configs):
+        raise ValueError("Partitioned joins need a 'period' column in every config")
+
+    base = table_configs[0]
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    shard_root = tempfile.mkdtemp(prefix="filteredStates_", dir=shard_dir)
+    building = f"{new_table_name}__building"
+
+    try:
+        ensure_join_indexes(cursor, table_configs)
+        conn.commit()
+
+        join_query, base_keys = build_aliased_query(cursor, table_configs)
+        check_width(cursor, join_query, table_configs, state_values)
+        partitions = cursor.execute(
+            f"""
+            SELECT DISTINCT {base['state']}, {base['period']} FROM {base['name']}
+            WHERE {base['state']} IN ({','.join(['?'] * len(state_values))})
+            """,
+            state_parameters(conn, table_configs, state_values),
+        ).fetchall()
+        where = f"WHERE t0.{base['state']} = ? AND t0.{base['period']} = ?"
+        print(f"Joining {len(partitions)} (state, period) partitions...")
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    join_partition,
+                    db_path,
+                    join_query,
+                    where,
+                    partition,
+                    os.path.join(shard_root, f"part{i}.db"),
+                ): i
+                for i, partition in enumerate(partitions)
+            }
+            shards = []
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="Partitions"
+            ):
+                shards.append((futures[future], *future.result()))
+
+        # Concatenate the shards; ATTACH is not allowed inside a transaction,
+        # so each shard is committed on its own into the temporary table
+        cursor.execute(f"DROP TABLE IF EXISTS {building}")
+        row_count = 0
+        # In partition order (part2 before part10), as the query returned them
+        for _, shard_path, rows in tqdm(sorted(shards), desc="Concatenating"):
+            cursor.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+            if not table_exists(conn, building):
+                cursor.execute(f"CREATE TABLE {building} AS SELECT * FROM shard.part")
+            else:
+                cursor.execute(f"INSERT INTO {building} SELECT * FROM shard.part")
+            conn.commit()
+            cursor.execute("DETACH DATABASE shard")
+            row_count += rows
+
+        if not shards:
+            cursor.execute(f"CREATE TABLE {building} AS {join_query} WHERE 0")
+
+        conn.execute("BEGIN TRANSACTION")
+        cursor.execute(f"ALTER TABLE {building} RENAME TO {new_table_name}")
+
+        create_key_index(cursor, new_table_name, base, base_keys)
+        conn.commit()
+        print(f"Successfully created table '{new_table_name}' with {row_count} rows")
+
+    except Exception as e:
+        conn.rollback()
+        cursor.execute(f"DROP TABLE IF EXISTS {building}")
+        conn.commit()
+        print(f"An error occurred: {e}")
+        raise
+
+    finally:
+        conn.close()
+        shutil.rmtree(shard_root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    # Example usage
+    db_path = "ladli.db"
+    new_table_name = "filteredStates"
+
+    # Configure your tables here
+    table_configs = [
+        {
+            "name": "people_of_india",
+            "hh_id": "HH_ID",
+            "month": "month",
+            "year": "year",
+            "period": "PERIOD",
+            "state": "STATE",
+        },
+        {
+            "name": "household_income",
+            "hh_id": "HH_ID",
+            "month": "DIR_MONTH",
+            "year": "DIR_YEAR",
+            "period": "PERIOD",
+            "state": "STATE",
+        },
+        {
+            "name": "consumption_pyramids",
+            "hh_id": "HH_ID",
+            "month": "DIR_MONTH",
+            "year": "DIR_YEAR",
+            "period": "PERIOD",
+            "state": "STATE",
+        },
+        {
+            "name": "aspirational_india",
+            "hh_id": "HH_ID",
+            "month": "month",
+            "year": "year",
+            "period": "PERIOD",
+            "state": "STATE",
+        },
+        # Add more table configurations as needed
+    ]
+
+    state_values = [
+        "Uttar Pradesh",
+        "Madhya Pradesh",
+        "Chhattisgarh",
+        "Jharkhand",
+        "Bihar",
+    ]  # Add the four allowed state values here
+
+    create_joined_table_partitioned(
+        db_path, new_table_name, table_configs, state_values
+    )
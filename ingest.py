@@ -0,0 +1,955 @@
+import os
+import time
+import argparse
+import hashlib
+import sqlite3
+import multiprocessing
+import pandas as pd
+from queue import Empty
+from pandas.api import types as ptypes
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from metrics import sql_timer, stage
+from rawCatalog import (
+    dataset_files,
+    open_binary,
+    open_source,
+    scan_raw_months,
+    source_stat,
+)
+
+# Rows per chunk when streaming CSVs; peak memory is bounded by roughly
+# (workers + queue_size + 1) chunks instead of growing with the file size
+DEFAULT_CHUNKSIZE = 200000
+
+# Columns whose dtype must not be left to per-chunk inference
+KEY_DTYPES = {
+    "HH_ID": "Int64",
+    "STATE": "object",
+    "DISTRICT": "object",
+    "REGION_TYPE": "object",
+}
+
+# Connection settings used while loading: no fsync per commit, a 1 GiB page
+# cache and memory-mapped I/O. journal_mode may also be "OFF", which is
+# faster still but leaves the database unrecoverable if the load crashes.
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "cache_size": -1048576,
+    "mmap_size": 1073741824,
+    "temp_store": "MEMORY",
+}
+
+# Restored once loading has finished
+SAFE_PRAGMAS = {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL",
+    "temp_store": "DEFAULT",
+}
+
+# Integer yyyymm key stored in every table alongside the text month/year
+PERIOD_COLUMN = "PERIOD"
+
+# Low-cardinality text columns that can be stored as integer codes. Month
+# names are left as text; PERIOD already gives them an integer key.
+DICT_COLUMNS = [
+    "STATE",
+    "DISTRICT",
+    "REGION_TYPE",
+    "GENDER",
+    "AGE_GROUP",
+    "OCCUPATION_GROUP",
+]
+
+# Records every file loaded into a database so re-runs can skip it
+MANIFEST_TABLE = "_ingest_manifest"
+
+# One descriptor per CPHS dataset. "month"/"year" are the columns the
+# directory-derived month and year are stored in for that table.
+DATASETS = {
+    "people_of_india": {
+        "table": "people_of_india",
+        "csv": "people_of_india.csv",
+        "month": "month",
+        "year": "year",
+        "db": "people_of_india.db",
+    },
+    "household_income": {
+        "table": "household_income",
+        "csv": "household_income.csv",
+        "month": "DIR_MONTH",
+        "year": "DIR_YEAR",
+        "db": "household_income.db",
+    },
+    "consumption_pyramids": {
+        "table": "consumption_pyramids",
+        "csv": "consumption_pyramids.csv",
+        "month": "DIR_MONTH",
+        "year": "DIR_YEAR",
+        "db": "consumption_pyramids.db",
+    },
+    "aspirational_india": {
+        "table": "aspirational_india",
+        "csv": "aspirational_india.csv",
+        "month": "month",
+        "year": "year",
+        "db": "aspirational_india.db",
+    },
+}
+
+
+def create_database_connection(db_file, bulk_load=False, journal_mode=None):
+    conn = None
+    try:
+        conn = sqlite3.connect(db_file)
+        print(f"SQLite Database connection successful. Database at {db_file}")
+        if bulk_load:
+            enable_bulk_load(conn, journal_mode)
+    except sqlite3.Error as e:
+        print(f"Error connecting to database: {e}")
+    return conn
+
+
+def apply_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+def enable_bulk_load(conn, journal_mode=None):
+    pragmas = dict(BULK_LOAD_PRAGMAS)
+    if journal_mode is not None:
+        pragmas["journal_mode"] = journal_mode
+    apply_pragmas(conn, pragmas)
+    print(f"Bulk load mode enabled (journal_mode={pragmas['journal_mode']})")
+
+
+def finish_bulk_load(conn):
+    # journal_mode cannot change inside a transaction, so commit first
+    conn.commit()
+    apply_pragmas(conn, SAFE_PRAGMAS)
+    conn.execute("ANALYZE")
+    conn.commit()
+    print("Restored safe database settings and refreshed statistics")
+
+
+def sqlite_type(dtype):
+    if ptypes.is_integer_dtype(dtype):
+        return "INTEGER"
+    elif ptypes.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def column_sqlite_type(series):
+    # Streamed files read numeric columns as float64 (see infer_dtypes); one
+    # holding only whole numbers is declared INTEGER, as the pre-scan does.
+    # SQLite then stores 12.0 as 12, and any later decimals as they are.
+    if ptypes.is_float_dtype(series.dtype) and series.notna().any():
+        return kind_sqlite_type(column_kind(series))
+    return sqlite_type(series.dtype)
+
+
+def infer_dtypes(file_path, sample_rows=10000, overrides=None):
+    # Fix one dtype per column up front so every chunk of the file parses
+    # the same way. Numeric columns are read as float64 because an integer
+    # sample does not guarantee the rest of the file has no blanks or
+    # decimals; text, and anything all-empty in the sample, stays object.
+    with open_source(file_path) as source:
+        sample = pd.read_csv(source, nrows=sample_rows)
+    dtypes = {}
+    for col in sample.columns:
+        if sample[col].isna().all() or not ptypes.is_numeric_dtype(sample[col]):
+            dtypes[col] = "object"
+        else:
+            dtypes[col] = "float64"
+
+    for col, dtype in {**KEY_DTYPES, **(overrides or {})}.items():
+        if col in dtypes:
+            dtypes[col] = dtype
+    return dtypes
+
+
+def period_key(month, year):
+    # ("Apr", "2022") -> 202204
+    return int(year) * 100 + datetime.strptime(month, "%b").month
+
+
+def add_period_column(conn, table, month_column, year_column):
+    # Backfill PERIOD for tables loaded before it was stored at ingest.
+    # This runs before every join, so the UPDATE (which rewrites the table)
+    # only runs when the column was just added or some row still lacks a
+    # PERIOD. The probe is read-only and stops at the first such row.
+    if PERIOD_COLUMN not in get_existing_columns(conn, table):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN "{PERIOD_COLUMN}" INTEGER')
+    elif not conn.execute(
+        f'SELECT EXISTS (SELECT 1 FROM {table} WHERE "{PERIOD_COLUMN}" IS NULL)'
+    ).fetchone()[0]:
+        return
+
+    months = " ".join(
+        f"WHEN '{datetime(2000, m, 1).strftime('%b')}' THEN {m}" for m in range(1, 13)
+    )
+    cursor = conn.execute(f"""
+        UPDATE {table}
+        SET "{PERIOD_COLUMN}" = CAST("{year_column}" AS INTEGER) * 100
+            + CASE "{month_column}" {months} END
+        WHERE "{PERIOD_COLUMN}" IS NULL
+    """)
+    if cursor.rowcount:
+        print(f"Backfilled {PERIOD_COLUMN} for {cursor.rowcount} rows in {table}")
+
+
+def table_exists(conn, table):
+    return (
+        conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)
+        ).fetchone()
+        is not None
+    )
+
+
+def get_existing_columns(conn, table):
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+
+def create_table_if_not_exists(conn, table, df, text_columns=()):
+    cursor = conn.cursor()
+
+    column_definitions = []
+    for col in df.columns:
+        if col in text_columns:
+            column_definitions.append(f'"{col}" TEXT')
+        else:
+            column_definitions.append(f'"{col}" {column_sqlite_type(df[col])}')
+
+    create_table_sql = f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        {', '.join(column_definitions)}
+    )
+    """
+
+    cursor.execute(create_table_sql)
+    print(f"Table '{table}' created or already exists")
+
+
+def add_missing_columns(conn, table, df, schema=None):
+    # schema, when given, is the cached {column: type} of the table; it is
+    # used instead of PRAGMA table_info and updated with the new columns
+    if schema is None:
+        schema = load_schema(conn, table)
+    new_columns = {
+        col: column_sqlite_type(df[col]) for col in df.columns if col not in schema
+    }
+    add_columns(conn, table, new_columns, schema)
+
+
+def add_columns(conn, table, columns, schema):
+    if columns:
+        cursor = conn.cursor()
+        for col, col_type in columns.items():
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN "{col}" {col_type}')
+        schema.update(columns)
+
+        print(f"Added new columns: {', '.join(columns)}")
+
+
+def load_schema(conn, table):
+    return {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+# Column kinds found by the pre-scan, from narrowest to widest. "intfloat"
+# is a float column whose values are all whole numbers (integers with
+# blanks), which is stored as INTEGER like "int" but read as float64.
+KINDS = [None, "int", "intfloat", "float", "text"]
+
+
+def column_kind(series):
+    values = series.dropna()
+    if values.empty:
+        return None
+    if ptypes.is_bool_dtype(series.dtype) or ptypes.is_integer_dtype(series.dtype):
+        return "int"
+    if ptypes.is_float_dtype(series.dtype):
+        return "intfloat" if (values == values.round()).all() else "float"
+    return "text"
+
+
+def widest_kind(a, b):
+    return a if KINDS.index(a) >= KINDS.index(b) else b
+
+
+def scan_file_kinds(file_path, chunksize=DEFAULT_CHUNKSIZE):
+    # Runs in a worker process: the kind of every column over the whole file
+    kinds = {}
+    with open_source(file_path) as source:
+        for df in pd.read_csv(source, chunksize=chunksize):
+            for col in df.columns:
+                kinds[col] = widest_kind(kinds.get(col), column_kind(df[col]))
+    kinds.pop("id", None)
+    return kinds
+
+
+def prescan_schema(file_paths, executor):
+    # One kind per column across every month, in first-seen column order,
+    # so the table can be created once and every chunk read the same way
+    kinds = {}
+    for file_kinds in executor.map(scan_file_kinds, file_paths):
+        for col, kind in file_kinds.items():
+            kinds[col] = widest_kind(kinds.get(col), kind)
+    print(f"Pre-scanned {len(file_paths)} files: {len(kinds)} columns")
+    return kinds
+
+
+def kind_sqlite_type(kind):
+    if kind in ("int", "intfloat"):
+        return "INTEGER"
+    elif kind == "float":
+        return "REAL"
+    # Text, and columns that were empty in every month
+    return "TEXT"
+
+
+def kind_dtype(kind):
+    if kind == "int":
+        return "Int64"
+    elif kind in ("intfloat", "float"):
+        return "float64"
+    return "object"
+
+
+def prepare_table(conn, dataset, kinds, schema, encode=False):
+    # Create the table with its final layout, or add every column the
+    # scanned files introduce in one batch, before any data is loaded.
+    # Returns the dtype map the files should be read with.
+    table = dataset["table"]
+    encode_columns = dataset.get("encode", DICT_COLUMNS) if encode else []
+
+    layout = {col: kind_sqlite_type(kind) for col, kind in kinds.items()}
+    layout.update(
+        {dataset["month"]: "TEXT", dataset["year"]: "TEXT", PERIOD_COLUMN: "INTEGER"}
+    )
+    for col in encode_columns:
+        if col in layout and col not in schema:
+            layout[col] = "INTEGER"
+            load_dictionary(conn, table, col)
+
+    if not schema:
+        column_definitions = [f'"{col}" {col_type}' for col, col_type in layout.items()]
+        conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {', '.join(column_definitions)}
+        )
+        """)
+        schema.update(load_schema(conn, table))
+        print(f"Table '{table}' created with {len(layout)} columns")
+    else:
+        add_columns(
+            conn,
+            table,
+            {col: t for col, t in layout.items() if col not in schema},
+            schema,
+        )
+
+    dtype = {col: kind_dtype(kind) for col, kind in kinds.items()}
+    for col, col_dtype in {**KEY_DTYPES, **dataset.get("dtypes", {})}.items():
+        if col in dtype:
+            dtype[col] = col_dtype
+    return dtype
+
+
+def column_values(series):
+    # One column as Python scalars sqlite3 can bind, missing values as None.
+    # Float NaN is left alone since SQLite stores a bound NaN as NULL.
+    if ptypes.is_float_dtype(series.dtype):
+        return series.tolist()
+    if ptypes.is_integer_dtype(series.dtype) and not series.hasnans:
+        return series.tolist()
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def iter_rows(df):
+    # Rows are zipped lazily from per-column lists, so executemany never sees
+    # a materialized list of tuples or a boxed object copy of the frame
+    return zip(*[column_values(df[col]) for col in df.columns])
+
+
+def insert_data(conn, table, df, commit=True):
+    cursor = conn.cursor()
+
+    columns = df.columns.tolist()
+    placeholders = ", ".join(["?" for _ in columns])
+    column_names = ", ".join([f'"{col}"' for col in columns])
+
+    sql = f"""
+    INSERT INTO {table} ({column_names})
+    VALUES ({placeholders})
+    """
+
+    cursor.executemany(sql, iter_rows(df))
+    if commit:
+        conn.commit()
+    print(f"Inserted {len(df)} rows into {table} table")
+
+
+def dict_table(table, column):
+    return f"{table}__{column}_dict"
+
+
+def encoded_columns(conn, table):
+    # A column is encoded exactly when its lookup table exists, so the
+    # encoding survives mergeDBs copying the tables into another database
+    prefix, suffix = f"{table}__", "_dict"
+    return [
+        name[len(prefix) : -len(suffix)]
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        if name.startswith(prefix) and name.endswith(suffix)
+    ]
+
+
+def dictionary_source(conn, table):
+    # Table whose dictionaries decode this one: itself, or for a joined
+    # table such as filteredStates its people_of_india base
+    if not encoded_columns(conn, table) and encoded_columns(conn, "people_of_india"):
+        return "people_of_india"
+    return table
+
+
+def copy_dictionaries(conn, target_conn, table, columns):
+    # Copy the lookup tables of table's encoded columns among columns to
+    # another database, under the same names. Does not commit.
+    copied = []
+    for col in encoded_columns(conn, table):
+        if col not in columns:
+            continue
+        load_dictionary(target_conn, table, col)
+        target_conn.executemany(
+            f"INSERT OR REPLACE INTO {dict_table(table, col)} VALUES (?, ?)",
+            conn.execute(f"SELECT code, value FROM {dict_table(table, col)}"),
+        )
+        copied.append(col)
+    return copied
+
+
+def load_dictionary(conn, table, column):
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {dict_table(table, column)} (
+        code INTEGER PRIMARY KEY,
+        value TEXT UNIQUE
+    )
+    """)
+    return {
+        value: code
+        for code, value in conn.execute(
+            f"SELECT code, value FROM {dict_table(table, column)}"
+        )
+    }
+
+
+def encode_frame(conn, table, df, columns, dictionaries):
+    # Replace the text values of the given columns with integer codes,
+    # adding unseen values to the lookup tables. dictionaries caches the
+    # value -> code maps between frames.
+    for col in columns:
+        if col not in df.columns:
+            continue
+        if col not in dictionaries:
+            dictionaries[col] = load_dictionary(conn, table, col)
+        mapping = dictionaries[col]
+
+        values = df[col].astype(object)
+        new_values = [v for v in values[values.notna()].unique() if v not in mapping]
+        if new_values:
+            first = max(mapping.values(), default=0) + 1
+            added = {v: first + i for i, v in enumerate(new_values)}
+            conn.executemany(
+                f"INSERT INTO {dict_table(table, col)} (code, value) VALUES (?, ?)",
+                [(code, str(value)) for value, code in added.items()],
+            )
+            mapping.update(added)
+
+        df[col] = values.map(mapping).astype("Int64")
+    return df
+
+
+def create_decoded_view(conn, table, view=None, dict_source=None):
+    # <table>_decoded shows the original strings in place of the codes.
+    # dict_source names the table whose lookups apply, for tables such as
+    # filteredStates that carry another table's encoded columns.
+    view = view or f"{table}_decoded"
+    dict_source = dict_source or table
+    columns = get_existing_columns(conn, table)
+    encoded = [col for col in encoded_columns(conn, dict_source) if col in columns]
+
+    select_columns = []
+    joins = []
+    for col in columns:
+        if col in encoded:
+            alias = f"d_{len(joins)}"
+            select_columns.append(f'{alias}.value AS "{col}"')
+            joins.append(
+                f"LEFT JOIN {dict_table(dict_source, col)} {alias} "
+                f'ON {alias}.code = t."{col}"'
+            )
+        else:
+            select_columns.append(f't."{col}"')
+
+    conn.execute(f"DROP VIEW IF EXISTS {view}")
+    if encoded:
+        conn.execute(f"""
+        CREATE VIEW {view} AS
+        SELECT {', '.join(select_columns)}
+        FROM {table} t
+        {' '.join(joins)}
+        """)
+        print(f"Created view '{view}' decoding {', '.join(encoded)}")
+
+
+def encoded_values(conn, table, column, values):
+    # Translate filter values (e.g. state names) to codes when the column
+    # is encoded; unknown values map to -1 so they match nothing
+    if column not in encoded_columns(conn, table):
+        return list(values)
+    mapping = load_dictionary(conn, table, column)
+    return [mapping.get(v, -1) for v in values]
+
+
+def write_frame(conn, dataset, df, commit=True, dictionaries=None, schema=None):
+    # With dictionaries (a dict, possibly empty) the dataset's DICT_COLUMNS
+    # are encoded: always for columns that already have a lookup table, and
+    # for columns that are not in the table yet. Existing text columns are
+    # never switched to codes. schema is the cached table layout; without
+    # it the layout is read from the database on every call.
+    table = dataset["table"]
+    if schema is None:
+        schema = load_schema(conn, table)
+
+    if dictionaries is not None:
+        encoded = encoded_columns(conn, table)
+        columns = [
+            col
+            for col in dataset.get("encode", DICT_COLUMNS)
+            if col in encoded or col not in schema
+        ]
+        df = encode_frame(conn, table, df, columns, dictionaries)
+
+    if not schema:
+        create_table_if_not_exists(
+            conn, table, df, text_columns=(dataset["month"], dataset["year"])
+        )
+        schema.update(load_schema(conn, table))
+    else:
+        add_missing_columns(conn, table, df, schema)
+
+    insert_data(conn, table, df, commit=commit)
+
+
+def find_month_files(root_dir, csv_name, catalog=None):
+    # (path, month, year) for each month directory holding the CSV, oldest
+    # first. catalog is a rawCatalog scan to reuse instead of walking the
+    # tree again.
+    if catalog is None:
+        catalog = scan_raw_months(root_dir, with_header_hash=False)
+    return dataset_files(catalog, csv_name[: -len(".csv")])
+
+
+def read_month_file(
+    file_path,
+    month,
+    year,
+    dataset,
+    queue,
+    chunksize=None,
+    parquet_root=None,
+    dtype=None,
+    stop=None,
+):
+    # Runs in a worker process. Parsed frames go to the writer through the
+    # queue, followed by a None marker once the file is finished. With a
+    # chunksize the file is streamed and each chunk is sent separately.
+    # With parquet_root the month is also written as a Parquet partition.
+    # dtype, from the pre-scan, fixes how every column is parsed. Once the
+    # stop event is set (the writer failed) nothing more is sent.
+    try:
+        if parquet_root:
+            import parquetStore
+
+            parquetStore.clear_partition(parquet_root, dataset["table"], year, month)
+
+        if chunksize and dtype is None:
+            dtype = infer_dtypes(file_path, overrides=dataset.get("dtypes"))
+
+        # .gz files and zip members are decompressed as they are parsed
+        with open_source(file_path) as source:
+            if chunksize:
+                chunks = pd.read_csv(source, chunksize=chunksize, dtype=dtype)
+            else:
+                chunks = [pd.read_csv(source, dtype=dtype)]
+
+            for df in chunks:
+                if "id" in df.columns:
+                    df = df.drop("id", axis=1)
+
+                if parquet_root:
+                    parquetStore.write_partition(
+                        df, parquet_root, dataset["table"], year, month, dtype=dtype
+                    )
+
+                df[dataset["month"]] = month
+                df[dataset["year"]] = year
+                df[PERIOD_COLUMN] = period_key(month, year)
+
+                if stop is not None and stop.is_set():
+                    return
+                queue.put((file_path, month, year, df))
+                del df
+    finally:
+        queue.put((file_path, month, year, None))
+
+
+def ensure_manifest(conn):
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+        path TEXT PRIMARY KEY,
+        dataset TEXT,
+        month TEXT,
+        year TEXT,
+        size INTEGER,
+        mtime REAL,
+        sha256 TEXT,
+        rows INTEGER,
+        ingested_at TEXT
+    )
+    """)
+
+
+def file_digest(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open_binary(file_path) as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def select_changed_files(conn, files, executor):
+    # Returns (file_path, month, year, stat, sha256) for every file that is
+    # new or whose content differs from what the manifest recorded. Files
+    # with unchanged size and mtime are skipped without being read; the
+    # rest are hashed in parallel.
+    ensure_manifest(conn)
+    recorded = {
+        row[0]: row[1:]
+        for row in conn.execute(
+            f"SELECT path, size, mtime, sha256 FROM {MANIFEST_TABLE}"
+        )
+    }
+
+    candidates = []
+    for file_path, month, year in files:
+        stat = source_stat(file_path)
+        previous = recorded.get(file_path)
+        if previous and previous[:2] == (stat.st_size, stat.st_mtime):
+            continue
+        candidates.append((file_path, month, year, stat))
+
+    digests = executor.map(file_digest, [c[0] for c in candidates])
+
+    changed = []
+    for (file_path, month, year, stat), digest in zip(candidates, digests):
+        previous = recorded.get(file_path)
+        if previous and previous[2] == digest:
+            # Touched but identical; just remember the new stat
+            conn.execute(
+                f"UPDATE {MANIFEST_TABLE} SET size = ?, mtime = ? WHERE path = ?",
+                (stat.st_size, stat.st_mtime, file_path),
+            )
+            continue
+        changed.append((file_path, month, year, stat, digest))
+
+    conn.commit()
+    print(f"{len(changed)} of {len(files)} files are new or changed")
+    return changed
+
+
+def missing_partitions(parquet_root, dataset, files, changed):
+    # Unchanged months with no Parquet partition yet, e.g. loaded before
+    # parquet_root was given; they are reloaded so the dataset is complete
+    import parquetStore
+
+    reloading = {c[0] for c in changed}
+    missing = [
+        (file_path, month, year, source_stat(file_path), file_digest(file_path))
+        for file_path, month, year in files
+        if file_path not in reloading
+        and not os.path.isdir(
+            parquetStore.partition_dir(parquet_root, dataset["table"], year, month)
+        )
+    ]
+    if missing:
+        print(f"{len(missing)} unchanged files have no Parquet partition yet")
+    return missing
+
+
+def delete_month_rows(conn, dataset, month, year):
+    # A month file is replaced as a whole, so clear whatever an earlier run
+    # (or a run from before the manifest existed) loaded for that month
+    table = dataset["table"]
+    if not table_exists(conn, table):
+        return
+    cursor = conn.execute(
+        f'DELETE FROM {table} WHERE "{dataset["month"]}" = ? AND "{dataset["year"]}" = ?',
+        (month, year),
+    )
+    if cursor.rowcount:
+        print(f"Removed {cursor.rowcount} previously loaded rows for {month} {year}")
+
+
+def record_manifest(conn, dataset, file_path, month, year, stat, digest, rows):
+    conn.execute(
+        f"""
+        INSERT OR REPLACE INTO {MANIFEST_TABLE}
+        (path, dataset, month, year, size, mtime, sha256, rows, ingested_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            file_path,
+            dataset["table"],
+            month,
+            year,
+            stat.st_size,
+            stat.st_mtime,
+            digest,
+            rows,
+            datetime.now().isoformat(timespec="seconds"),
+        ),
+    )
+
+
+def ingest_dataset(
+    root_dir,
+    conn,
+    dataset,
+    workers=None,
+    queue_size=4,
+    chunksize=DEFAULT_CHUNKSIZE,
+    commit_every=1,
+    incremental=True,
+    parquet_root=None,
+    encode=False,
+    prescan=False,
+    catalog=None,
+    panel_index=False,
+    mp_context=None,
+):
+    # Files are streamed chunksize rows at a time; chunksize=None reads
+    # each month whole, so several months can be in memory at once (one per
+    # parser plus the queue). commit_every is the number of month files per
+    # transaction; None loads the whole run in a single transaction. With
+    # incremental, files already recorded in the manifest are skipped and
+    # changed ones are replaced.
+    # parquet_root additionally writes each month to a Parquet dataset.
+    # encode stores low-cardinality text columns as dictionary codes.
+    # prescan reads the files once beforehand to settle every column's type
+    # and create the table in its final layout. panel_index adds the table
+    # to the panelIndex HH_ID lookup; once indexed, the months loaded are
+    # re-indexed on every run, whoever calls this. mp_context is the
+    # multiprocessing context of the parser pool and its queue's manager.
+    # It defaults to forkserver: the stage's RSS sampler thread, and the
+    # pipeline's other ingests, are running when the pool starts, and
+    # forking a multi-threaded process can deadlock the children.
+    # Returns the stage's metrics record (see metrics.stage): rows, bytes
+    # read, time spent waiting on the parsers and time spent in SQLite.
+    files = find_month_files(root_dir, dataset["csv"], catalog)
+    if not files:
+        print(f"No {dataset['csv']} files found under '{root_dir}'")
+        return None
+
+    mp_context = mp_context or multiprocessing.get_context("forkserver")
+    db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    with stage(
+        f"ingest.{dataset['table']}", outputs=[db_path] if db_path else ()
+    ) as record, mp_context.Manager() as manager:
+        # Bounded so parsers cannot run arbitrarily far ahead of the writer
+        queue = manager.Queue(maxsize=queue_size)
+        stop = manager.Event()
+
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=mp_context
+        ) as executor:
+            if incremental:
+                changed = select_changed_files(conn, files, executor)
+                if parquet_root:
+                    changed += missing_partitions(parquet_root, dataset, files, changed)
+                files = changed
+            else:
+                files = [(path, month, year, None, None) for path, month, year in files]
+            record["files"] = len(files)
+            record["bytes_read"] = sum(
+                (stat or source_stat(path)).st_size for path, _, _, stat, _ in files
+            )
+
+            # Cached table layout, so frames need no PRAGMA round trips
+            schema = load_schema(conn, dataset["table"])
+            dtype = None
+            if prescan and files:
+                start = time.perf_counter()
+                kinds = prescan_schema([f[0] for f in files], executor)
+                dtype = prepare_table(conn, dataset, kinds, schema, encode)
+                record["prescan_seconds"] = round(time.perf_counter() - start, 3)
+
+            for file_path, month, year, stat, digest in files:
+                with sql_timer(record, "delete"):
+                    delete_month_rows(conn, dataset, month, year)
+
+            futures = {
+                file_path: executor.submit(
+                    read_month_file,
+                    file_path,
+                    month,
+                    year,
+                    dataset,
+                    queue,
+                    chunksize,
+                    parquet_root,
+                    dtype,
+                    stop,
+                )
+                for file_path, month, year, stat, digest in files
+            }
+            pending = {
+                file_path: (stat, digest) for file_path, _, _, stat, digest in files
+            }
+            rows = dict.fromkeys(futures, 0)
+            dictionaries = {} if encode else None
+
+            # Single writer: only this process touches the SQLite connection.
+            # Time blocked on the queue is time the CSV parsers are behind.
+            waiting = 0.0
+            remaining = len(futures)
+            try:
+                while remaining:
+                    start = time.perf_counter()
+                    file_path, month, year, df = queue.get()
+                    waiting += time.perf_counter() - start
+                    if df is not None:
+                        with sql_timer(record, "insert"):
+                            write_frame(
+                                conn,
+                                dataset,
+                                df,
+                                commit=False,
+                                dictionaries=dictionaries,
+                                schema=schema,
+                            )
+                        rows[file_path] += len(df)
+                        del df
+                        continue
+
+                    remaining -= 1
+                    # The marker is queued as the worker returns, so this is quick
+                    if futures[file_path].exception() is not None:
+                        print(
+                            f"Failed to load {file_path}; it will be retried next run"
+                        )
+                        continue
+
+                    stat, digest = pending[file_path]
+                    if incremental:
+                        record_manifest(
+                            conn,
+                            dataset,
+                            file_path,
+                            month,
+                            year,
+                            stat,
+                            digest,
+                            rows[file_path],
+                        )
+                    finished = len(futures) - remaining
+                    if commit_every and finished % commit_every == 0:
+                        with sql_timer(record, "commit"):
+                            conn.commit()
+                    print(f"Processed {dataset['csv']} for {month} {year}")
+            except BaseException:
+                # Parsers blocked on the full queue would keep the pool from
+                # shutting down: stop them, then drain until every one exits
+                stop.set()
+                for future in futures.values():
+                    future.cancel()
+                while not all(future.done() for future in futures.values()):
+                    try:
+                        queue.get(timeout=0.1)
+                    except Empty:
+                        pass
+                raise
+
+            if encode and table_exists(conn, dataset["table"]):
+                create_decoded_view(conn, dataset["table"])
+            if files and table_exists(conn, dataset["table"]):
+                import panelIndex
+
+                table = dataset["table"]
+                if panel_index or table in panelIndex.indexed_tables(conn):
+                    with sql_timer(record, "panel_index"):
+                        panelIndex.update_panel_index(
+                            conn,
+                            table,
+                            [period_key(month, year) for _, month, year, _, _ in files],
+                        )
+            with sql_timer(record, "commit"):
+                conn.commit()
+            record["rows"] = sum(rows.values())
+            record["parse_wait_seconds"] = round(waiting, 3)
+            for future in futures.values():
+                future.result()
+
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load the CPHS month files")
+    parser.add_argument("datasets", nargs="*", help="default: all of them")
+    parser.add_argument("--raw", default="raw months", help="raw months directory")
+    parser.add_argument(
+        "--parquet-root", default=None, help="also write a Parquet dataset here"
+    )
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.datasets if name not in DATASETS]
+    if unknown:
+        parser.error(f"unknown datasets: {', '.join(unknown)}")
+
+    root_dir = args.raw
+    names = args.datasets or list(DATASETS)
+    catalog = scan_raw_months(root_dir)
+
+    for name in names:
+        dataset = DATASETS[name]
+        db_file = dataset["db"]
+
+        conn = create_database_connection(db_file, bulk_load=True)
+        if conn is not None:
+            ingest_dataset(
+                root_dir,
+                conn,
+                dataset,
+                chunksize=DEFAULT_CHUNKSIZE,
+                commit_every=None,
+                prescan=True,
+                catalog=catalog,
+                parquet_root=args.parquet_root,
+            )
+            finish_bulk_load(conn)
+            conn.close()
+            print(f"Database '{db_file}' has been populated with {name} data.")
+        else:
+            print("Failed to create database connection.")
+
+
+if __name__ == "__main__":
+    main()
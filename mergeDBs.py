@@ -1,83 +1,329 @@
 import sqlite3
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+from metrics import file_bytes, sql_timer, stage
+from panelIndex import CLUSTER_SUFFIX, PANEL_INDEX, rebuild_panel
 
-def combine_databases(source_dbs, target_db, chunk_size=10000):
+# Per-database bookkeeping that should not be merged
+SKIP_TABLES = ("_ingest_manifest", PANEL_INDEX)
+
+
+def table_columns(cursor, schema, table):
+    return [row[1] for row in cursor.execute(f'PRAGMA {schema}.table_info("{table}")')]
+
+
+def iter_keyset_pages(cursor, source, columns, chunk_size):
+    # Stream rows in rowid order; each page seeks straight to the last rowid
+    # seen instead of rescanning from the start like LIMIT/OFFSET
+    column_names = ", ".join([f'"{col}"' for col in columns])
+    select_sql = (
+        f"SELECT rowid, {column_names} FROM {source} "
+        f"WHERE rowid > ? ORDER BY rowid LIMIT {chunk_size}"
+    )
+
+    last_rowid = -(2**63)
+    while True:
+        rows = cursor.execute(select_sql, (last_rowid,)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+def insert_sql(table, columns):
+    column_names = ", ".join([f'"{col}"' for col in columns])
+    placeholders = ", ".join(["?" for _ in columns])
+    return f'INSERT INTO main."{table}" ({column_names}) VALUES ({placeholders})'
+
+
+def copy_table_keyset(cursor, schema, table, columns, chunk_size, pbar):
+    sql = insert_sql(table, columns)
+    for rows in iter_keyset_pages(cursor, f'{schema}."{table}"', columns, chunk_size):
+        cursor.executemany(sql, rows)
+        pbar.update(len(rows))
+
+
+def skip_table(table_name):
+    # SQLite's internal tables (sqlite_sequence, sqlite_stat1), bookkeeping,
+    # and clustered panel copies, which are rebuilt from the merged tables
+    return (
+        table_name.startswith("sqlite_")
+        or table_name in SKIP_TABLES
+        or table_name.endswith(CLUSTER_SUFFIX)
+    )
+
+
+def panel_tables(cursor, schema):
+    # Tables the source keeps in the panel index, and those it clusters
+    names = [
+        row[0]
+        for row in cursor.execute(
+            f"SELECT name FROM {schema}.sqlite_master WHERE type='table'"
+        )
+    ]
+    indexed = []
+    if PANEL_INDEX in names:
+        indexed = [
+            row[0]
+            for row in cursor.execute(
+                f"SELECT DISTINCT table_name FROM {schema}.{PANEL_INDEX}"
+            )
+        ]
+    clustered = [
+        name[: -len(CLUSTER_SUFFIX)] for name in names if name.endswith(CLUSTER_SUFFIX)
+    ]
+    return indexed, clustered
+
+
+def copy_views(cursor, views):
+    # Views such as the <table>_decoded ones over dictionary-encoded tables;
+    # created after the tables they select from
+    for view_name, create_view_sql in views:
+        cursor.execute(f'DROP VIEW IF EXISTS main."{view_name}"')
+        cursor.execute(create_view_sql)
+
+
+def combine_databases(source_dbs, target_db, chunk_size=10000, replace=True):
     # Connect to the target database
     target_conn = sqlite3.connect(target_db)
     target_cursor = target_conn.cursor()
 
-    # Outer progress bar for databases
-    for source_db in tqdm(source_dbs, desc="Processing databases"):
-        # Connect to the source database
-        source_conn = sqlite3.connect(source_db)
-        source_cursor = source_conn.cursor()
+    # Attach every source up front: ATTACH/DETACH are not allowed inside the
+    # transaction that does the copying
+    schemas = {}
+    for i, source_db in enumerate(source_dbs):
+        schemas[source_db] = f"src{i}"
+        target_cursor.execute(f"ATTACH DATABASE ? AS src{i}", (source_db,))
 
-        # Get all table names from the source database
-        source_cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = source_cursor.fetchall()
+    with stage("merge", outputs=[target_db], sources=len(source_dbs)) as record:
+        record["bytes_read"] = file_bytes(*source_dbs)
+        record["rows"] = 0
+        indexed, clustered = set(), set()
+        try:
+            target_cursor.execute("BEGIN TRANSACTION")
 
-        # Inner progress bar for tables
-        for table in tqdm(
-            tables, desc=f"Tables in {os.path.basename(source_db)}", leave=False
-        ):
-            table_name = table[0]
+            # Outer progress bar for databases
+            for source_db in tqdm(source_dbs, desc="Processing databases"):
+                schema = schemas[source_db]
+                source_indexed, source_clustered = panel_tables(target_cursor, schema)
+                indexed.update(source_indexed)
+                clustered.update(source_clustered)
+
+                # Get all table names and CREATE TABLE sql from the source database
+                tables = target_cursor.execute(
+                    f"SELECT name, sql FROM {schema}.sqlite_master "
+                    "WHERE type='table';"
+                ).fetchall()
+
+                # Inner progress bar for tables
+                for table_name, create_table_sql in tqdm(
+                    tables, desc=f"Tables in {os.path.basename(source_db)}", leave=False
+                ):
+                    if skip_table(table_name):
+                        continue
+
+                    columns = table_columns(target_cursor, schema, table_name)
+                    existing = table_columns(target_cursor, "main", table_name)
 
-            # Skip the sqlite_sequence table
-            if table_name == "sqlite_sequence":
+                    if replace or not existing:
+                        # Recreate the table in the target database
+                        target_cursor.execute(
+                            f'DROP TABLE IF EXISTS main."{table_name}";'
+                        )
+                        target_cursor.execute(create_table_sql)
+                        existing = shared = columns
+                    else:
+                        # Appending: leave out the id key so rows get fresh ids
+                        shared = [c for c in columns if c in existing and c != "id"]
+
+                    with tqdm(
+                        desc=f"Copying {table_name}", unit="rows", leave=False
+                    ) as pbar:
+                        if existing == columns:
+                            # Same layout: let SQLite copy the pages itself
+                            column_names = ", ".join([f'"{col}"' for col in shared])
+                            with sql_timer(record, "insert_select"):
+                                target_cursor.execute(
+                                    f'INSERT INTO main."{table_name}" '
+                                    f"({column_names}) SELECT {column_names} "
+                                    f'FROM {schema}."{table_name}"'
+                                )
+                            pbar.update(target_cursor.rowcount)
+                        else:
+                            # Layouts differ: copy the shared columns in rowid pages
+                            with sql_timer(record, "keyset_copy"):
+                                copy_table_keyset(
+                                    target_cursor,
+                                    schema,
+                                    table_name,
+                                    shared,
+                                    chunk_size,
+                                    pbar,
+                                )
+                        record["rows"] += pbar.n
+
+                copy_views(
+                    target_cursor,
+                    target_cursor.execute(
+                        f"SELECT name, sql FROM {schema}.sqlite_master "
+                        "WHERE type='view';"
+                    ).fetchall(),
+                )
+
+            with sql_timer(record, "panel_index"):
+                rebuild_panel(target_conn, sorted(indexed), sorted(clustered))
+            with sql_timer(record, "commit"):
+                target_conn.commit()
+        except Exception:
+            target_conn.rollback()
+            raise
+        finally:
+            for schema in schemas.values():
+                target_cursor.execute(f"DETACH DATABASE {schema}")
+            target_conn.close()
+
+    print("All databases combined successfully!")
+
+
+def read_source_tables(source_db, tables, chunk_size, batches, stop):
+    # Runs in a reader thread with its own connection. Each table is sent as
+    # ("rows", table, rows) pages followed by ("done", table, None).
+    source_conn = sqlite3.connect(source_db)
+    try:
+        for table_name, columns in tables:
+            for rows in iter_keyset_pages(
+                source_conn.cursor(), f'"{table_name}"', columns, chunk_size
+            ):
+                if stop.is_set():
+                    return
+                batches.put(("rows", table_name, rows))
+            if stop.is_set():
+                return
+            batches.put(("done", table_name, None))
+    finally:
+        source_conn.close()
+
+
+def combine_databases_parallel(
+    source_dbs, target_db, chunk_size=10000, queue_size=8, workers=None
+):
+    # Source databases are read concurrently by reader threads (sqlite3
+    # releases the GIL while stepping queries); pages go through a bounded
+    # queue to this thread, the only one writing to the target
+    target_conn = sqlite3.connect(target_db)
+    target_cursor = target_conn.cursor()
+
+    # Like combine_databases, a table present in several sources is
+    # replaced by the last one, so only that source reads it
+    owners = {}
+    views = []
+    indexed, clustered = set(), set()
+    for source_db in source_dbs:
+        source_conn = sqlite3.connect(source_db)
+        for table_name, create_table_sql in source_conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type='table';"
+        ):
+            if skip_table(table_name):
                 continue
+            columns = table_columns(source_conn.cursor(), "main", table_name)
+            owners[table_name] = (source_db, create_table_sql, columns)
+        source_indexed, source_clustered = panel_tables(source_conn.cursor(), "main")
+        indexed.update(source_indexed)
+        clustered.update(source_clustered)
+        views.extend(
+            source_conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type='view';"
+            ).fetchall()
+        )
+        source_conn.close()
 
-            # Fetch the CREATE TABLE sql for this table
-            source_cursor.execute(
-                f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}';"
-            )
-            create_table_sql = source_cursor.fetchone()[0]
-
-            # Create the table in the target database
-            target_cursor.execute(f"DROP TABLE IF EXISTS {table_name};")
-            target_cursor.execute(create_table_sql)
-
-            # Get column names
-            source_cursor.execute(f"PRAGMA table_info({table_name})")
-            columns = [col[1] for col in source_cursor.fetchall()]
-            placeholders = ", ".join(["?" for _ in columns])
-
-            # Get total number of rows
-            source_cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-            total_rows = source_cursor.fetchone()[0]
-
-            # Copy data in chunks with progress bar
-            with tqdm(
-                total=total_rows, desc=f"Copying {table_name}", unit="rows", leave=False
-            ) as pbar:
-                for offset in range(0, total_rows, chunk_size):
-                    source_cursor.execute(
-                        f"SELECT * FROM {table_name} LIMIT {chunk_size} OFFSET {offset}"
-                    )
-                    data = source_cursor.fetchall()
+    work = {}
+    for table_name, (source_db, create_table_sql, columns) in owners.items():
+        work.setdefault(source_db, []).append((table_name, columns))
+
+    with stage(
+        "merge", outputs=[target_db], sources=len(source_dbs), readers=len(work)
+    ) as record:
+        record["bytes_read"] = file_bytes(*source_dbs)
+        batches = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        bars = {}
+        try:
+            target_cursor.execute("BEGIN TRANSACTION")
+            for table_name, (source_db, create_table_sql, columns) in owners.items():
+                target_cursor.execute(f'DROP TABLE IF EXISTS main."{table_name}";')
+                target_cursor.execute(create_table_sql)
+                bars[table_name] = tqdm(
+                    desc=f"Copying {table_name}", unit="rows", position=len(bars)
+                )
 
-                    target_cursor.executemany(
-                        f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})",
-                        data,
+            with ThreadPoolExecutor(max_workers=workers or len(work) or 1) as executor:
+                futures = [
+                    executor.submit(
+                        read_source_tables, source_db, tables, chunk_size, batches, stop
                     )
-                    target_conn.commit()
+                    for source_db, tables in work.items()
+                ]
 
-                    pbar.update(len(data))
+                remaining = len(owners)
+                try:
+                    while remaining:
+                        try:
+                            kind, table_name, rows = batches.get(timeout=1)
+                        except queue.Empty:
+                            # A reader that died will never finish its tables
+                            for future in futures:
+                                if future.done() and future.exception():
+                                    raise future.exception()
+                            continue
 
-        source_conn.close()
+                        if kind == "done":
+                            remaining -= 1
+                            bars[table_name].close()
+                            continue
+                        with sql_timer(record, "insert"):
+                            target_cursor.executemany(
+                                insert_sql(table_name, owners[table_name][2]), rows
+                            )
+                        bars[table_name].update(len(rows))
+                finally:
+                    # Unblock readers waiting on a full queue if the writer failed
+                    stop.set()
+                    while not batches.empty():
+                        batches.get_nowait()
+
+                for future in futures:
+                    future.result()
+
+            copy_views(target_cursor, views)
+            with sql_timer(record, "panel_index"):
+                rebuild_panel(target_conn, sorted(indexed), sorted(clustered))
+            with sql_timer(record, "commit"):
+                target_conn.commit()
+            record["rows"] = sum(bar.n for bar in bars.values())
+        except Exception:
+            target_conn.rollback()
+            raise
+        finally:
+            for bar in bars.values():
+                bar.close()
+            target_conn.close()
 
-    target_conn.close()
     print("All databases combined successfully!")
 
 
-# Usage
-source_databases = [
-    "aspirational_india.db",
-    "consumption_pyramids.db",
-    "people_of_india.db",
-    "household_income.db",
-]
-combined_database = "ladli.db"
+if __name__ == "__main__":
+    # Usage
+    source_databases = [
+        "aspirational_india.db",
+        "consumption_pyramids.db",
+        "people_of_india.db",
+        "household_income.db",
+    ]
+    combined_database = "ladli.db"
 
-combine_databases(source_databases, combined_database, chunk_size=50000)
+    combine_databases(source_databases, combined_database, chunk_size=50000)
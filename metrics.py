@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# JSON lines are appended here when set, e.g. PIPELINE_METRICS=metrics.jsonl;
+# off by default so library calls write nothing. pipeline.py turns it on
+# with --metrics.
+METRICS_FILE = os.environ.get("PIPELINE_METRICS", "")
+
+# Seconds between RSS samples while a stage runs
+RSS_INTERVAL = float(os.environ.get("PIPELINE_RSS_INTERVAL", "0.05"))
+
+# Stages whose name starts with this are run under cProfile, e.g.
+# PIPELINE_PROFILE=ingest or PIPELINE_PROFILE=join.filteredStates
+PROFILE_STAGE = os.environ.get("PIPELINE_PROFILE", "")
+PROFILE_DIR = os.environ.get("PIPELINE_PROFILE_DIR", ".")
+
+
+def set_metrics_file(path):
+    global METRICS_FILE
+    METRICS_FILE = path or ""
+
+
+def peak_rss_mb():
+    # High-water marks since the process started, of this process and of
+    # its largest (pool) child; they never go down, so they cannot tell
+    # one stage from the next. See rss_sampler for per-stage peaks.
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return round(own, 1), round(children, 1)
+
+
+def rss_mb(pid):
+    # Current resident set size from /proc (Linux); None where unavailable
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def child_pids(pid):
+    # Every descendant of pid, e.g. the ingest parser pools
+    found = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return found
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children = [int(child) for child in f.read().split()]
+        except OSError:
+            continue
+        for child in children:
+            found += [child] + child_pids(child)
+    return found
+
+
+@contextmanager
+def rss_sampler(interval=None):
+    # Polls the RSS of this process and the sum over its descendants from a
+    # background thread, and yields a dict that holds the peaks seen while
+    # the block ran. Stages running side by side in one process (pipeline
+    # --jobs) share these figures. Peaks are None without /proc.
+    interval = RSS_INTERVAL if interval is None else interval
+    peaks = {"peak_rss_mb": None, "peak_children_rss_mb": None}
+    done = threading.Event()
+
+    def sample():
+        own = rss_mb(os.getpid())
+        if own is None:
+            return
+        children = sum(rss_mb(pid) or 0.0 for pid in child_pids(os.getpid()))
+        for key, value in (("peak_rss_mb", own), ("peak_children_rss_mb", children)):
+            if peaks[key] is None or value > peaks[key]:
+                peaks[key] = value
+
+    def run():
+        while not done.wait(interval):
+            sample()
+
+    sample()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield peaks
+    finally:
+        done.set()
+        thread.join()
+        sample()
+        for key, value in peaks.items():
+            if value is not None:
+                peaks[key] = round(value, 1)
+
+
+def file_bytes(*paths):
+    # Size on disk, counting SQLite's -wal file alongside a database
+    total = 0
+    for path in paths:
+        for name in (path, f"{path}-wal"):
+            if os.path.exists(name):
+                total += os.path.getsize(name)
+    return total
+
+
+def emit(record):
+    if not METRICS_FILE:
+        return
+    with open(METRICS_FILE, "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+@contextmanager
+def stage(name, outputs=(), **fields):
+    # Times a pipeline stage and emits one JSON line when it ends. The
+    # yielded dict can be filled in by the stage: rows, bytes_read, and
+    # any extra fields; sql_timer() adds statement times under "sql".
+    # bytes_written is how much the files in outputs grew; peak_rss_mb and
+    # peak_children_rss_mb are sampled while the stage runs.
+    record = {"event": "stage", "stage": name, "pid": os.getpid(), **fields}
+    record["started_at"] = datetime.now().isoformat(timespec="seconds")
+    size_before = file_bytes(*outputs)
+
+    profiler = None
+    if PROFILE_STAGE and name.startswith(PROFILE_STAGE):
+        # The pid lets py-spy attach to the same run: py-spy record -p <pid>
+        print(f"Profiling stage '{name}' in pid {os.getpid()}")
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        with rss_sampler() as peaks:
+            yield record
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        if profiler is not None:
+            profiler.disable()
+            profile_path = os.path.join(PROFILE_DIR, f"{name}.{os.getpid()}.prof")
+            profiler.dump_stats(profile_path)
+            record["profile"] = profile_path
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+        for timing in record.get("sql", {}).values():
+            timing["seconds"] = round(timing["seconds"], 3)
+        if outputs:
+            record["bytes_written"] = file_bytes(*outputs) - size_before
+        if record.get("rows") and record["seconds"]:
+            record["rows_per_sec"] = round(record["rows"] / record["seconds"])
+        # Sampled during this stage; the process-wide high-water mark is
+        # kept separately under its own name
+        record.update(peaks)
+        record["process_max_rss_mb"] = peak_rss_mb()[0]
+        record["status"] = "error" if "error" in record else "ok"
+        emit(record)
+
+
+@contextmanager
+def sql_timer(record, label):
+    # Accumulates time and call count for a statement kind in record["sql"]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = record.setdefault("sql", {}).setdefault(
+            label, {"calls": 0, "seconds": 0.0}
+        )
+        timing["calls"] += 1
+        timing["seconds"] += time.perf_counter() - start
@@ -0,0 +1,223 @@
+import sys
+import sqlite3
+import argparse
+import pandas as pd
+
+from ingest import DATASETS, table_exists
+
+# HH_ID -> (table, PERIOD, rowid range) for every household-month of the
+# indexed tables. Keyed on HH_ID first, so one household's entries sit on
+# a single page whatever the number of tables and months.
+PANEL_INDEX = "_panel_index"
+
+# Optional copies of a table keyed on (HH_ID, PERIOD), so a household's
+# rows are stored together instead of spread over every month's load
+CLUSTER_SUFFIX = "_by_hh"
+
+
+def clustered_table(table):
+    return f"{table}{CLUSTER_SUFFIX}"
+
+
+def ensure_panel_index(conn):
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {PANEL_INDEX} (
+        HH_ID INTEGER NOT NULL,
+        table_name TEXT NOT NULL,
+        PERIOD INTEGER NOT NULL,
+        first_rowid INTEGER,
+        last_rowid INTEGER,
+        n INTEGER,
+        PRIMARY KEY (HH_ID, table_name, PERIOD)
+    ) WITHOUT ROWID
+    """)
+
+
+def period_condition(periods, column="PERIOD"):
+    # SQL condition and parameters limiting a statement to some periods;
+    # periods=None means all of them
+    if periods is None:
+        return "1", []
+    periods = sorted(set(int(p) for p in periods))
+    return f"{column} IN ({', '.join(['?' for _ in periods])})", periods
+
+
+def update_panel_index(conn, table, periods=None, hh_id="HH_ID"):
+    # (Re)index the given periods of a table, all of them by default, and
+    # refresh its clustered copy if it has one. Does not commit.
+    ensure_panel_index(conn)
+    condition, params = period_condition(periods)
+    conn.execute(
+        f"DELETE FROM {PANEL_INDEX} WHERE table_name = ? AND {condition}",
+        [table] + params,
+    )
+    cursor = conn.execute(
+        f"""
+        INSERT INTO {PANEL_INDEX}
+        SELECT {hh_id}, ?, PERIOD, MIN(rowid), MAX(rowid), COUNT(*)
+        FROM {table}
+        WHERE {hh_id} IS NOT NULL AND PERIOD IS NOT NULL AND {condition}
+        GROUP BY {hh_id}, PERIOD
+        """,
+        [table] + params,
+    )
+    print(f"Panel index: {cursor.rowcount} household-months of '{table}'")
+
+    if table_exists(conn, clustered_table(table)):
+        update_clustered_table(conn, table, periods, hh_id)
+    return cursor.rowcount
+
+
+def create_clustered_table(conn, table, hh_id="HH_ID"):
+    # WITHOUT ROWID copy of the table keyed on (HH_ID, PERIOD, source rowid)
+    columns = [
+        (name, declared)
+        for _, name, declared, *_ in conn.execute(f"PRAGMA table_info({table})")
+    ]
+    definitions = [f'"{name}" {declared}' for name, declared in columns]
+    definitions.append("src_rowid INTEGER")
+    conn.execute(f"DROP TABLE IF EXISTS {clustered_table(table)}")
+    conn.execute(f"""
+    CREATE TABLE {clustered_table(table)} (
+        {', '.join(definitions)},
+        PRIMARY KEY ({hh_id}, PERIOD, src_rowid)
+    ) WITHOUT ROWID
+    """)
+
+
+def sync_clustered_columns(conn, table):
+    # Add the columns a later month introduced to the clustered copy; rows
+    # already in it read NULL there, as they do in the table
+    existing = {
+        row[1] for row in conn.execute(f"PRAGMA table_info({clustered_table(table)})")
+    }
+    columns = [
+        (name, declared)
+        for _, name, declared, *_ in conn.execute(f"PRAGMA table_info({table})")
+    ]
+    for name, declared in columns:
+        if name not in existing:
+            conn.execute(
+                f'ALTER TABLE {clustered_table(table)} ADD COLUMN "{name}" {declared}'
+            )
+    return [name for name, _ in columns]
+
+
+def update_clustered_table(conn, table, periods=None, hh_id="HH_ID"):
+    columns = ", ".join(f'"{name}"' for name in sync_clustered_columns(conn, table))
+    condition, params = period_condition(periods)
+    conn.execute(f"DELETE FROM {clustered_table(table)} WHERE {condition}", params)
+    # Inserting in key order appends to the b-tree instead of splitting pages
+    conn.execute(
+        f"""
+        INSERT INTO {clustered_table(table)} ({columns}, src_rowid)
+        SELECT {columns}, rowid FROM {table}
+        WHERE {hh_id} IS NOT NULL AND PERIOD IS NOT NULL AND {condition}
+        ORDER BY {hh_id}, PERIOD, rowid
+        """,
+        params,
+    )
+
+
+def indexed_tables(conn):
+    if not table_exists(conn, PANEL_INDEX):
+        return []
+    return [
+        row[0] for row in conn.execute(f"SELECT DISTINCT table_name FROM {PANEL_INDEX}")
+    ]
+
+
+def rebuild_panel(conn, tables, clustered=()):
+    # Index (and cluster) tables copied into another database by mergeDBs,
+    # which does not carry the index over since rowids may differ there.
+    # Does not commit.
+    for table in clustered:
+        if table_exists(conn, table):
+            create_clustered_table(conn, table)
+    for table in tables:
+        if table_exists(conn, table):
+            update_panel_index(conn, table)
+
+
+def households_history(conn, hh_ids, tables=None, hh_id="HH_ID"):
+    # Every row of the given households, as {table: DataFrame} ordered by
+    # HH_ID and PERIOD. Clustered tables are read by primary key range;
+    # others through the panel index, one rowid range per household-month.
+    # CROSS JOIN keeps the id list as the outer loop, so the cost grows with
+    # the number of households asked for rather than the table size.
+    hh_ids = [int(h) for h in hh_ids]
+    conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS _panel_ids (HH_ID INTEGER PRIMARY KEY)"
+    )
+    conn.execute("DELETE FROM temp._panel_ids")
+    conn.executemany(
+        "INSERT OR IGNORE INTO temp._panel_ids VALUES (?)", [(h,) for h in hh_ids]
+    )
+
+    history = {}
+    for table in tables or indexed_tables(conn):
+        if table_exists(conn, clustered_table(table)):
+            query = f"""
+            SELECT c.* FROM temp._panel_ids i
+            CROSS JOIN {clustered_table(table)} c ON c.{hh_id} = i.HH_ID
+            ORDER BY c.{hh_id}, c.PERIOD, c.src_rowid
+            """
+            df = pd.read_sql_query(query, conn).drop(columns="src_rowid")
+        else:
+            query = f"""
+            SELECT t.* FROM temp._panel_ids i
+            CROSS JOIN {PANEL_INDEX} p ON p.HH_ID = i.HH_ID AND p.table_name = ?
+            CROSS JOIN {table} t
+              ON t.rowid BETWEEN p.first_rowid AND p.last_rowid
+             AND t.{hh_id} = p.HH_ID AND t.PERIOD = p.PERIOD
+            ORDER BY p.HH_ID, p.PERIOD, t.rowid
+            """
+            df = pd.read_sql_query(query, conn, params=(table,))
+        history[table] = df
+    conn.execute("DELETE FROM temp._panel_ids")
+    return history
+
+
+def household_history(conn, hh_id, tables=None):
+    # One household's time series in each indexed table
+    return households_history(conn, [hh_id], tables)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the HH_ID panel index or look up household histories"
+    )
+    parser.add_argument("--db", default="ladli.db")
+    parser.add_argument("--tables", nargs="*", default=None)
+    parser.add_argument(
+        "--cluster", action="store_true", help="also keep <table>_by_hh copies"
+    )
+    parser.add_argument(
+        "--lookup", nargs="*", type=int, default=None, help="HH_IDs to print"
+    )
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.lookup:
+            for table, df in households_history(conn, args.lookup, args.tables).items():
+                print(f"{table}: {len(df)} rows")
+                df.to_csv(sys.stdout, index=False)
+            return
+
+        tables = args.tables or [
+            dataset["table"]
+            for dataset in DATASETS.values()
+            if table_exists(conn, dataset["table"])
+        ]
+        for table in tables:
+            if args.cluster:
+                create_clustered_table(conn, table)
+            update_panel_index(conn, table)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import os
+import uuid
+import shutil
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.types as pt
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pandas.api import types as ptypes
+
+# Layout: <root>/<dataset>/year=<YYYY>/month=<M>/part-<uuid>.parquet
+# year and month are hive partition keys, so filters on them skip whole
+# directories; within each part every STATE is its own row group, so
+# row-group statistics let the reader skip the other states.
+
+
+def month_number(month):
+    if isinstance(month, str) and not month.isdigit():
+        return datetime.strptime(month, "%b").month
+    return int(month)
+
+
+def partition_dir(root, dataset, year, month):
+    return os.path.join(
+        root, dataset, f"year={int(year)}", f"month={month_number(month)}"
+    )
+
+
+def clear_partition(root, dataset, year, month):
+    path = partition_dir(root, dataset, year, month)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def arrow_type(dtype):
+    # Arrow type a column read with this pandas dtype is stored as
+    if ptypes.is_bool_dtype(dtype):
+        return pa.bool_()
+    if ptypes.is_integer_dtype(dtype):
+        return pa.int64()
+    if ptypes.is_numeric_dtype(dtype):
+        return pa.float64()
+    return pa.string()
+
+
+def write_partition(
+    df, root, dataset, year, month, drop=(), state_column="STATE", dtype=None
+):
+    # drop removes columns that duplicate the partition keys (month/year,
+    # DIR_MONTH/DIR_YEAR) so they do not clash with them on read. dtype is
+    # the ingest dtype map: columns in it are stored with the matching
+    # Arrow type, so every month of a column read the same way is written
+    # the same way. Columns with no values at all stay Arrow's null type
+    # and take the other months' type on read (see dataset_schema).
+    path = partition_dir(root, dataset, year, month)
+    os.makedirs(path, exist_ok=True)
+
+    df = df.drop(columns=[col for col in drop if col in df.columns])
+    # Row group sizes: one per STATE in sorted order, or the whole frame
+    group_sizes = [len(df)]
+    if state_column in df.columns:
+        df = df.sort_values(state_column, kind="stable")
+        group_sizes = df.groupby(state_column, sort=False, dropna=False).size().tolist()
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if dtype:
+        table = table.cast(
+            pa.schema(
+                [
+                    (
+                        pa.field(field.name, arrow_type(dtype[field.name]))
+                        if field.name in dtype and not pt.is_null(field.type)
+                        else field
+                    )
+                    for field in table.schema
+                ]
+            )
+        )
+    file_path = os.path.join(path, f"part-{uuid.uuid4().hex}.parquet")
+    with pq.ParquetWriter(file_path, table.schema) as writer:
+        offset = 0
+        for size in group_sizes:
+            writer.write_table(table.slice(offset, size))
+            offset += size
+    return file_path
+
+
+def unify_types(types):
+    # One type for a column written with different types in different
+    # months: null (all empty) gives way to anything, integers widen to
+    # double, and anything else mixed is read as string
+    types = [t for t in set(types) if not pt.is_null(t)]
+    if not types:
+        return pa.null()
+    if len(types) == 1:
+        return types[0]
+    if all(pt.is_integer(t) for t in types):
+        return pa.int64()
+    if all(pt.is_integer(t) or pt.is_floating(t) for t in types):
+        return pa.float64()
+    return pa.string()
+
+
+def dataset_schema(path):
+    # Schema covering every part file, in first-seen column order, plus the
+    # year/month partition keys. Only the Parquet footers are read.
+    types = {}
+    for dirpath, _, filenames in os.walk(path):
+        for name in sorted(filenames):
+            if name.endswith(".parquet"):
+                for field in pq.read_schema(os.path.join(dirpath, name)):
+                    types.setdefault(field.name, []).append(field.type)
+    fields = [
+        pa.field(name, unify_types(column_types))
+        for name, column_types in types.items()
+        if name not in ("year", "month")
+    ]
+    return pa.schema(
+        fields + [pa.field("year", pa.int32()), pa.field("month", pa.int32())]
+    )
+
+
+def open_dataset(root, dataset):
+    # Months are written with their own types, so the dataset is opened
+    # with the unified schema; each part is cast to it as it is scanned
+    path = os.path.join(root, dataset)
+    return ds.dataset(
+        path, schema=dataset_schema(path), format="parquet", partitioning="hive"
+    )
+
+
+def read_dataset(
+    root,
+    dataset,
+    columns=None,
+    states=None,
+    years=None,
+    months=None,
+    state_column="STATE",
+    to_pandas=True,
+):
+    # Only the requested columns are decoded, and only partitions / row
+    # groups that can match the STATE, year and month filters are scanned
+    data = open_dataset(root, dataset)
+
+    conditions = []
+    if years is not None:
+        conditions.append(ds.field("year").isin([int(y) for y in years]))
+    if months is not None:
+        conditions.append(ds.field("month").isin([month_number(m) for m in months]))
+    if states is not None:
+        conditions.append(ds.field(state_column).isin(list(states)))
+
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    table = data.to_table(columns=columns, filter=condition)
+    return table.to_pandas() if to_pandas else table
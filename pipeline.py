@@ -0,0 +1,548 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import filterColumn
+from filterStates import (
+    WATERMARK_TABLE,
+    build_join_query,
+    dataset_join_configs,
+    refresh_joined_table,
+    state_parameters,
+)
+from ingest import (
+    DATASETS,
+    DEFAULT_CHUNKSIZE,
+    MANIFEST_TABLE,
+    create_database_connection,
+    finish_bulk_load,
+    ingest_dataset,
+    period_key,
+    table_exists,
+)
+from mergeDBs import combine_databases
+from metrics import emit, set_metrics_file
+from weightedAgg import DEFAULT_WEIGHT
+from rawCatalog import scan_raw_months
+from rename import rename_csv_files
+from rollupCube import cube_name, refresh_cube
+
+# States kept by the join stage
+DEFAULT_STATES = [
+    "Uttar Pradesh",
+    "Madhya Pradesh",
+    "Chhattisgarh",
+    "Jharkhand",
+    "Bihar",
+]
+
+# Bookkeeping kept in the merged database: the ingest manifest each dataset
+# was last merged at, and the settings each joined table was built with
+MERGED_SOURCES_TABLE = "_merged_sources"
+JOIN_SETTINGS_TABLE = "_join_settings"
+
+
+def fingerprint(*parts):
+    # Stable hash of JSON-serialisable stage inputs
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def tree_listing(catalog, dataset=None):
+    # What a stage reads from the raw months tree: paths, sizes and mtimes
+    return [
+        (e["path"], e["size"], e["mtime"])
+        for e in catalog
+        if dataset is None or e["dataset"] == dataset
+    ]
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {"stages": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    # Written to a temporary file first so a crash never leaves it truncated
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def has_table(db_path, table):
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        return table_exists(conn, table)
+    finally:
+        conn.close()
+
+
+def manifest_digest(db_path):
+    # Hash of the month files a dataset database holds, or None without a
+    # manifest (the dataset is then always treated as changed)
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    try:
+        if not table_exists(conn, MANIFEST_TABLE):
+            return None
+        rows = conn.execute(
+            f"SELECT path, sha256, rows FROM {MANIFEST_TABLE} ORDER BY path"
+        ).fetchall()
+    finally:
+        conn.close()
+    return fingerprint(rows)
+
+
+def manifest_entries(db_paths):
+    # Every month file the dataset databases hold, as [path, sha256, PERIOD]
+    entries = []
+    for db_path in db_paths:
+        if not os.path.exists(db_path):
+            continue
+        conn = sqlite3.connect(db_path)
+        try:
+            if not table_exists(conn, MANIFEST_TABLE):
+                continue
+            rows = conn.execute(
+                f"SELECT path, sha256, month, year FROM {MANIFEST_TABLE}"
+            ).fetchall()
+        finally:
+            conn.close()
+        entries.extend(
+            [path, sha256, period_key(month, year)]
+            for path, sha256, month, year in rows
+        )
+    return sorted(entries)
+
+
+def earliest_changed_period(previous, current):
+    # Earliest PERIOD of a month file added, replaced or removed between two
+    # manifest_entries snapshots
+    before = {tuple(entry) for entry in previous}
+    after = {tuple(entry) for entry in current}
+    return min((entry[2] for entry in before ^ after), default=None)
+
+
+def join_settings(conn, table_configs, states):
+    # What the joined table's layout depends on: the states kept and the
+    # columns the join query returns. None if the query cannot be planned.
+    try:
+        description = conn.execute(
+            f"{build_join_query(table_configs, states)} LIMIT 0",
+            state_parameters(conn, table_configs, states),
+        ).description
+    except sqlite3.Error:
+        return None
+    return json.dumps(
+        {"states": sorted(states), "columns": [d[0] for d in description]}
+    )
+
+
+def make_context(args):
+    # Paths and settings shared by the stages; "catalog" is the latest scan
+    # of the raw months tree, "join_refresh" what this run's join rewrote
+    return {
+        "args": args,
+        "raw_dir": args.raw,
+        "dataset_dbs": {
+            name: os.path.join(args.work_dir, dataset["db"])
+            for name, dataset in DATASETS.items()
+        },
+        "merged_db": os.path.join(args.work_dir, args.db),
+        "columns_db": os.path.join(args.work_dir, args.columns_db),
+        "catalog": None,
+        "join_refresh": None,
+    }
+
+
+def scan(ctx):
+    ctx["catalog"] = scan_raw_months(ctx["raw_dir"], with_header_hash=False)
+
+
+def run_rename(ctx):
+    rename_csv_files(ctx["raw_dir"], ctx["catalog"])
+    # Renaming changed the paths the ingest stages fingerprint
+    scan(ctx)
+
+
+def run_ingest(ctx, name):
+    db_file = ctx["dataset_dbs"][name]
+    conn = create_database_connection(db_file, bulk_load=True)
+    if conn is None:
+        raise RuntimeError(f"Could not open {db_file}")
+    try:
+        ingest_dataset(
+            ctx["raw_dir"],
+            conn,
+            DATASETS[name],
+            workers=ctx["args"].workers,
+            chunksize=DEFAULT_CHUNKSIZE,
+            commit_every=None,
+            prescan=True,
+            catalog=ctx["catalog"],
+            panel_index=ctx["args"].panel_index,
+            parquet_root=ctx["args"].parquet_root,
+        )
+        finish_bulk_load(conn)
+    finally:
+        conn.close()
+
+
+def run_merge(ctx):
+    # Only datasets whose manifest changed since they were last merged are
+    # copied again; the others keep their tables and the join indexes on them
+    merged_db = ctx["merged_db"]
+    digests = {name: manifest_digest(ctx["dataset_dbs"][name]) for name in DATASETS}
+    conn = sqlite3.connect(merged_db)
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {MERGED_SOURCES_TABLE} (
+        dataset TEXT PRIMARY KEY,
+        manifest TEXT,
+        merged_at TEXT
+    )
+    """)
+    conn.commit()
+    merged = dict(conn.execute(f"SELECT dataset, manifest FROM {MERGED_SOURCES_TABLE}"))
+    conn.close()
+
+    changed = [
+        name
+        for name, dataset in DATASETS.items()
+        if digests[name] is None
+        or digests[name] != merged.get(name)
+        or not has_table(merged_db, dataset["table"])
+    ]
+    if not changed:
+        print("Every dataset is already merged")
+        return
+    print(f"Merging {', '.join(changed)}")
+    combine_databases(
+        [ctx["dataset_dbs"][name] for name in changed], merged_db, chunk_size=50000
+    )
+
+    conn = sqlite3.connect(merged_db)
+    merged_at = datetime.now().isoformat(timespec="seconds")
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {MERGED_SOURCES_TABLE} VALUES (?, ?, ?)",
+        [(name, digests[name], merged_at) for name in changed],
+    )
+    conn.commit()
+    conn.close()
+
+
+def run_join(ctx):
+    # Refreshed from the earliest period whose month files changed since the
+    # last refresh. Rebuilt in full only when the states or the joined
+    # columns changed, or when there is nothing to compare against.
+    args = ctx["args"]
+    configs = dataset_join_configs()
+    conn = sqlite3.connect(ctx["merged_db"])
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {JOIN_SETTINGS_TABLE} (
+        table_name TEXT PRIMARY KEY,
+        settings TEXT,
+        manifest TEXT
+    )
+    """)
+    settings = join_settings(conn, configs, args.states)
+    previous = conn.execute(
+        f"SELECT settings, manifest FROM {JOIN_SETTINGS_TABLE} WHERE table_name = ?",
+        (args.table,),
+    ).fetchone()
+    watermark = None
+    if table_exists(conn, WATERMARK_TABLE):
+        watermark = conn.execute(
+            f"SELECT period FROM {WATERMARK_TABLE} WHERE table_name = ?",
+            (args.table,),
+        ).fetchone()
+    manifest = manifest_entries(ctx["dataset_dbs"].values())
+
+    since = None
+    rebuilt = False
+    if (
+        settings is None
+        or previous is None
+        or previous[0] != settings
+        or watermark is None
+        or not table_exists(conn, args.table)
+    ):
+        print(f"Rebuilding '{args.table}' in full")
+        rebuilt = True
+        conn.execute(f"DROP TABLE IF EXISTS {args.table}")
+        if table_exists(conn, WATERMARK_TABLE):
+            conn.execute(
+                f"DELETE FROM {WATERMARK_TABLE} WHERE table_name = ?", (args.table,)
+            )
+    else:
+        since = earliest_changed_period(json.loads(previous[1]), manifest)
+        if since is not None:
+            print(f"Refreshing '{args.table}' from period {since}")
+    conn.commit()
+    conn.close()
+    # The rollup recomputes what the join rewrote
+    ctx["join_refresh"] = {"rebuilt": rebuilt, "since": since}
+
+    record = refresh_joined_table(
+        ctx["merged_db"], args.table, configs, args.states, since=since
+    )
+    if record.get("error") or not has_table(ctx["merged_db"], args.table):
+        raise RuntimeError(f"Join of '{args.table}' failed: {record.get('error')}")
+
+    conn = sqlite3.connect(ctx["merged_db"])
+    conn.execute(
+        f"INSERT OR REPLACE INTO {JOIN_SETTINGS_TABLE} VALUES (?, ?, ?)",
+        (args.table, join_settings(conn, configs, args.states), json.dumps(manifest)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def run_rollup(ctx):
+    # Rebuilt with the joined table, otherwise checked from the period the
+    # join refreshed from; the cube's per-period row counts catch new and
+    # resized periods, e.g. when this run's join stage was skipped.
+    join_refresh = ctx["join_refresh"] or {}
+    refresh_cube(
+        ctx["merged_db"],
+        ctx["args"].table,
+        weight=ctx["args"].weight,
+        since=join_refresh.get("since"),
+        rebuild=join_refresh.get("rebuilt", False),
+    )
+
+
+def run_columns(ctx):
+    args = ctx["args"]
+    conn_new = sqlite3.connect(ctx["columns_db"])
+    conn_new.execute(f'DROP TABLE IF EXISTS "{args.output_table}"')
+    conn_new.commit()
+    conn_new.close()
+
+    conn = sqlite3.connect(ctx["merged_db"])
+    try:
+        columns = [name for name, _ in filterColumn.get_table_columns(conn, args.table)]
+        if not args.all_columns:
+            columns = filterColumn.get_matching_columns(columns)
+        filterColumn.extract_columns(
+            conn, args.table, columns, ctx["columns_db"], args.output_table
+        )
+    finally:
+        conn.close()
+
+
+def build_stages():
+    # rename -> ingest.<dataset> (x4, concurrent) -> merge -> join -> rollup
+    # -> columns. The last three share the merged database, so they run one
+    # after another rather than contending for its write lock.
+    # "inputs" fingerprints what a stage reads: the raw files for rename and
+    # the ingests, otherwise its parameters and its dependencies'
+    # fingerprints, so a change upstream reruns exactly what is downstream
+    # of it. "outputs" checks that what it wrote is still there.
+    stages = {
+        "rename": {
+            "deps": [],
+            "run": run_rename,
+            "inputs": lambda ctx, deps: fingerprint(tree_listing(ctx["catalog"])),
+            "outputs": lambda ctx: True,
+        }
+    }
+    for name in DATASETS:
+        stages[f"ingest.{name}"] = {
+            "deps": ["rename"],
+            "run": lambda ctx, name=name: run_ingest(ctx, name),
+            "inputs": lambda ctx, deps, name=name: fingerprint(
+                tree_listing(ctx["catalog"], name),
+                ctx["args"].panel_index,
+                ctx["args"].parquet_root,
+            ),
+            "outputs": lambda ctx, name=name: has_table(
+                ctx["dataset_dbs"][name], DATASETS[name]["table"]
+            ),
+        }
+    stages["merge"] = {
+        "deps": [f"ingest.{name}" for name in DATASETS],
+        "run": run_merge,
+        "inputs": lambda ctx, deps: fingerprint(deps),
+        "outputs": lambda ctx: all(
+            has_table(ctx["merged_db"], dataset["table"])
+            for dataset in DATASETS.values()
+        ),
+    }
+    stages["join"] = {
+        "deps": ["merge"],
+        "run": run_join,
+        "inputs": lambda ctx, deps: fingerprint(
+            deps, ctx["args"].table, sorted(ctx["args"].states)
+        ),
+        "outputs": lambda ctx: has_table(ctx["merged_db"], ctx["args"].table),
+    }
+    stages["rollup"] = {
+        "deps": ["join"],
+        "run": run_rollup,
+        "inputs": lambda ctx, deps: fingerprint(deps, ctx["args"].weight),
+        "outputs": lambda ctx: has_table(
+            ctx["merged_db"], cube_name(ctx["args"].table)
+        ),
+    }
+    stages["columns"] = {
+        "deps": ["rollup"],
+        "run": run_columns,
+        "inputs": lambda ctx, deps: fingerprint(
+            deps, ctx["args"].output_table, ctx["args"].all_columns
+        ),
+        "outputs": lambda ctx: has_table(ctx["columns_db"], ctx["args"].output_table),
+    }
+    return stages
+
+
+def timed_run(stage_spec, ctx):
+    start = time.perf_counter()
+    stage_spec["run"](ctx)
+    return time.perf_counter() - start
+
+
+def run_pipeline(ctx, stages, state_path, jobs, force=False, dry_run=False):
+    # Stages whose dependencies are done run concurrently, up to jobs at a
+    # time. Returns False if any stage failed; its dependents are not run.
+    state = load_state(state_path)
+    recorded = state["stages"]
+    scan(ctx)
+
+    fingerprints = {}
+    done = set()
+    failed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(done) + len(failed) < len(stages):
+            for name, spec in stages.items():
+                if name in done or name in failed or name in running.values():
+                    continue
+                if any(dep in failed for dep in spec["deps"]):
+                    print(f"[{name}] not run: a dependency failed")
+                    failed.add(name)
+                    continue
+                if not all(dep in done for dep in spec["deps"]):
+                    continue
+
+                deps = [fingerprints[dep] for dep in spec["deps"]]
+                fingerprints[name] = spec["inputs"](ctx, deps)
+                previous = recorded.get(name, {}).get("fingerprint")
+                if (
+                    not force
+                    and previous == fingerprints[name]
+                    and spec["outputs"](ctx)
+                ):
+                    print(f"[{name}] up to date, skipped")
+                    emit({"event": "skip", "stage": name})
+                    done.add(name)
+                    continue
+                if dry_run:
+                    print(f"[{name}] would run")
+                    done.add(name)
+                    continue
+
+                print(f"[{name}] running")
+                running[executor.submit(timed_run, spec, ctx)] = name
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    print(f"[{name}] failed: {e!r}")
+                    failed.add(name)
+                    recorded.pop(name, None)
+                    save_state(state_path, state)
+                    continue
+
+                # Stages such as rename change their own inputs
+                deps = [fingerprints[dep] for dep in stages[name]["deps"]]
+                fingerprints[name] = stages[name]["inputs"](ctx, deps)
+                recorded[name] = {
+                    "fingerprint": fingerprints[name],
+                    "finished_at": datetime.now().isoformat(timespec="seconds"),
+                    "seconds": round(seconds, 3),
+                }
+                save_state(state_path, state)
+                print(f"[{name}] done in {seconds:.1f}s")
+                done.add(name)
+
+    return not failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run rename -> ingest -> merge -> join -> rollup -> columns, "
+        "skipping stages whose inputs are unchanged"
+    )
+    parser.add_argument("--raw", default="raw months", help="raw months directory")
+    parser.add_argument("--work-dir", default=".", help="where databases are written")
+    parser.add_argument("--db", default="ladli.db", help="merged database")
+    parser.add_argument("--table", default="filteredStates", help="joined table")
+    parser.add_argument("--columns-db", default="filteredStatesAllColumns.db")
+    parser.add_argument("--output-table", default="filtered_table")
+    parser.add_argument("--all-columns", action="store_true")
+    parser.add_argument("--states", nargs="+", default=DEFAULT_STATES)
+    parser.add_argument("--weight", default=DEFAULT_WEIGHT, help="rollup cube weight")
+    parser.add_argument(
+        "--jobs", type=int, default=len(DATASETS), help="stages run at once"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="parser processes per ingest (default: CPUs / jobs)",
+    )
+    parser.add_argument(
+        "--panel-index", action="store_true", help="keep the HH_ID panel index"
+    )
+    parser.add_argument(
+        "--parquet-root", default=None, help="also write a Parquet dataset here"
+    )
+    parser.add_argument("--state-file", default=".pipeline_state.json")
+    parser.add_argument(
+        "--metrics",
+        default="pipeline_metrics.jsonl",
+        help="JSON lines file in the work dir for stage metrics ('' for none)",
+    )
+    parser.add_argument("--force", action="store_true", help="rerun every stage")
+    parser.add_argument("--dry-run", action="store_true", help="only show the plan")
+    args = parser.parse_args(argv)
+
+    # The ingests run side by side, so split the CPUs between their pools
+    if args.workers is None:
+        args.workers = max(1, (os.cpu_count() or 1) // max(1, args.jobs))
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    state_path = os.path.join(args.work_dir, args.state_file)
+    if args.metrics:
+        set_metrics_file(os.path.join(args.work_dir, args.metrics))
+    ok = run_pipeline(
+        make_context(args),
+        build_stages(),
+        state_path,
+        args.jobs,
+        force=args.force,
+        dry_run=args.dry_run,
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import os
+import sys
+import gzip
+import hashlib
+import sqlite3
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+# List of prefixes we're looking for
+PREFIXES = [
+    "aspirational_india",
+    "consumption_pyramids",
+    "household_income",
+    "people_of_india",
+]
+
+CATALOG_TABLE = "_raw_catalog"
+
+# CSVs inside a zip are addressed as "<archive>.zip::<member>"
+ARCHIVE_SEPARATOR = "::"
+
+
+def match_prefix(filename):
+    # Plain and gzip-compressed CSVs
+    for prefix in PREFIXES:
+        if filename.startswith(prefix) and filename.endswith((".csv", ".csv.gz")):
+            return prefix
+    return None
+
+
+def is_plain_csv(path):
+    return ARCHIVE_SEPARATOR not in path and not path.endswith(".gz")
+
+
+@contextmanager
+def open_binary(path):
+    # Binary stream over a source, decompressing .gz files and zip members
+    # on the fly so archives never have to be extracted to disk
+    if ARCHIVE_SEPARATOR in path:
+        archive, member = path.split(ARCHIVE_SEPARATOR, 1)
+        with zipfile.ZipFile(archive) as zf, zf.open(member) as f:
+            yield f
+    elif path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            yield f
+    else:
+        with open(path, "rb") as f:
+            yield f
+
+
+@contextmanager
+def open_source(path):
+    # Something pd.read_csv accepts: plain CSVs are passed by path so pandas
+    # opens them itself, archives as a decompressing stream
+    if is_plain_csv(path):
+        yield path
+    else:
+        with open_binary(path) as f:
+            yield f
+
+
+def source_stat(path):
+    # Size and mtime of a source; for zip members the uncompressed size and
+    # the member's own timestamp
+    if ARCHIVE_SEPARATOR in path:
+        archive, member = path.split(ARCHIVE_SEPARATOR, 1)
+        with zipfile.ZipFile(archive) as zf:
+            info = zf.getinfo(member)
+        return SimpleNamespace(
+            st_size=info.file_size,
+            st_mtime=datetime(*info.date_time).timestamp(),
+        )
+    return os.stat(path)
+
+
+def parse_month_dir(dir_name):
+    # "Apr 2022" -> ("Apr", "2022"); (None, None) for other directories
+    try:
+        date = datetime.strptime(dir_name, "%b %Y")
+    except ValueError:
+        return None, None
+    return date.strftime("%b"), str(date.year)
+
+
+def header_hash(file_path):
+    # Hash of the header line, to spot column changes between months
+    with open_binary(file_path) as f:
+        return hashlib.sha1(f.readline().rstrip(b"\r\n")).hexdigest()
+
+
+def scan_zip(zip_path, with_header_hash=True):
+    # Entries for the dataset CSVs inside a zip. The month comes from the
+    # member's directory ("Apr 2022/household_income.csv"), else from the
+    # archive name ("Apr 2022.zip"), else from the directory holding it.
+    stem = os.path.basename(zip_path)[: -len(".zip")]
+    outer = os.path.basename(os.path.dirname(zip_path))
+    entries = []
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            dataset = match_prefix(os.path.basename(info.filename))
+            if dataset is None:
+                continue
+            for candidate in (
+                os.path.basename(os.path.dirname(info.filename)),
+                stem,
+                outer,
+            ):
+                month, year = parse_month_dir(candidate)
+                if month is not None:
+                    break
+            path = f"{zip_path}{ARCHIVE_SEPARATOR}{info.filename}"
+            entries.append(
+                {
+                    "dataset": dataset,
+                    "month": month,
+                    "year": year,
+                    "path": path,
+                    "size": info.file_size,
+                    "mtime": datetime(*info.date_time).timestamp(),
+                    "header_hash": header_hash(path) if with_header_hash else None,
+                }
+            )
+    return entries
+
+
+def scan_raw_months(root_dir, with_header_hash=True):
+    # One os.scandir pass over the tree. Every CSV matching a dataset prefix
+    # becomes an entry with its month directory, size, mtime and header hash;
+    # .csv.gz files and CSVs inside .zip archives are included.
+    entries = []
+    stack = [root_dir]
+    while stack:
+        dirpath = stack.pop()
+        month, year = parse_month_dir(os.path.basename(dirpath))
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                if entry.name.endswith(".zip"):
+                    entries.extend(scan_zip(entry.path, with_header_hash))
+                    continue
+                dataset = match_prefix(entry.name)
+                if dataset is None:
+                    continue
+                stat = entry.stat()
+                entries.append(
+                    {
+                        "dataset": dataset,
+                        "month": month,
+                        "year": year,
+                        "path": entry.path,
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                        "header_hash": (
+                            header_hash(entry.path) if with_header_hash else None
+                        ),
+                    }
+                )
+
+    entries.sort(key=lambda e: e["path"])
+    print(f"Catalogued {len(entries)} CSV files under '{root_dir}'")
+    return entries
+
+
+def source_kind(path):
+    # Precedence between sources of the same month: a plain CSV, then a
+    # .csv.gz, then a member of a zip
+    if ARCHIVE_SEPARATOR in path:
+        return 2
+    return 1 if path.endswith(".gz") else 0
+
+
+def dataset_files(catalog, dataset):
+    # (path, month, year) of one dataset's monthly CSVs, oldest first, one
+    # source per month. When a month has several (an extracted CSV next to
+    # the zip it came from, or "<dataset>.csv" next to a not yet renamed
+    # "<dataset>_....csv"), plain CSVs win over .gz files over zip members,
+    # and within a kind the exact "<dataset>.csv" name wins.
+    by_month = {}
+    for entry in catalog:
+        if entry["dataset"] != dataset:
+            continue
+        if entry["month"] is None:
+            dirpath = os.path.dirname(entry["path"])
+            print(f"Skipping directory with invalid name format: {dirpath}")
+            continue
+        exact = os.path.basename(entry["path"]) in (
+            f"{dataset}.csv",
+            f"{dataset}.csv.gz",
+        )
+        rank = (source_kind(entry["path"]), not exact, entry["path"])
+        by_month.setdefault((entry["month"], entry["year"]), []).append((rank, entry))
+
+    found = []
+    for (month, year), candidates in by_month.items():
+        candidates.sort(key=lambda c: c[0])
+        found.append(candidates[0][1])
+        for _, skipped in candidates[1:]:
+            print(
+                f"Skipping {skipped['path']}: {month} {year} is loaded from "
+                f"{candidates[0][1]['path']}"
+            )
+
+    found.sort(key=lambda e: datetime.strptime(f"{e['month']} {e['year']}", "%b %Y"))
+    return [(e["path"], e["month"], e["year"]) for e in found]
+
+
+def save_catalog(conn, catalog):
+    conn.execute(f"DROP TABLE IF EXISTS {CATALOG_TABLE}")
+    conn.execute(f"""
+    CREATE TABLE {CATALOG_TABLE} (
+        path TEXT PRIMARY KEY,
+        dataset TEXT,
+        month TEXT,
+        year TEXT,
+        size INTEGER,
+        mtime REAL,
+        header_hash TEXT
+    )
+    """)
+    conn.executemany(
+        f"""
+        INSERT INTO {CATALOG_TABLE}
+        VALUES (:path, :dataset, :month, :year, :size, :mtime, :header_hash)
+        """,
+        catalog,
+    )
+    conn.commit()
+
+
+def load_catalog(conn):
+    cursor = conn.execute(
+        f"SELECT path, dataset, month, year, size, mtime, header_hash "
+        f"FROM {CATALOG_TABLE} ORDER BY path"
+    )
+    columns = [d[0] for d in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def main():
+    root_dir = sys.argv[1] if len(sys.argv) > 1 else "raw months"
+    catalog_db = sys.argv[2] if len(sys.argv) > 2 else "raw_catalog.db"
+
+    catalog = scan_raw_months(root_dir)
+    conn = sqlite3.connect(catalog_db)
+    save_catalog(conn, catalog)
+    conn.close()
+    print(f"Catalog written to '{catalog_db}'")
+
+
+if __name__ == "__main__":
+    main()
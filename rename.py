@@ -1,34 +1,37 @@
 import os
-import glob
-
-
-def rename_csv_files(directory):
-    # List of prefixes we're looking for
-    prefixes = [
-        "aspirational_india",
-        "consumption_pyramids",
-        "household_income",
-        "people_of_india",
-    ]
-
-    # Walk through all subdirectories
-    for root, dirs, files in os.walk(directory):
-        for prefix in prefixes:
-            # Find all CSV files starting with the current prefix
-            matching_files = glob.glob(os.path.join(root, f"{prefix}*.csv"))
-
-            for file in matching_files:
-                # Construct the new filename
-                new_name = os.path.join(root, f"{prefix}.csv")
-
-                # Rename the file
-                try:
-                    os.rename(file, new_name)
-                    print(f"Renamed {file} to {new_name}")
-                except OSError as e:
-                    print(f"Error renaming {file}: {e}")
-
-
-# Usage
-directory_path = "."  # Replace with your directory path
-rename_csv_files(directory_path)
+
+from rawCatalog import is_plain_csv, scan_raw_months
+
+
+def rename_csv_files(directory, catalog=None):
+    # Files like "household_income_20220401.csv" become "household_income.csv".
+    # catalog is a rawCatalog scan to reuse instead of walking the tree again.
+    if catalog is None:
+        catalog = scan_raw_months(directory, with_header_hash=False)
+
+    for entry in catalog:
+        file = entry["path"]
+        # Compressed files and zip members are read in place, not renamed
+        if not is_plain_csv(file):
+            continue
+        root = os.path.dirname(file)
+        prefix = entry["dataset"]
+
+        # Construct the new filename
+        new_name = os.path.join(root, f"{prefix}.csv")
+        if file == new_name:
+            continue
+
+        # Rename the file
+        try:
+            os.rename(file, new_name)
+            entry["path"] = new_name
+            print(f"Renamed {file} to {new_name}")
+        except OSError as e:
+            print(f"Error renaming {file}: {e}")
+
+
+if __name__ == "__main__":
+    # Usage
+    directory_path = "."  # Replace with your directory path
+    rename_csv_files(directory_path)
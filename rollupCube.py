@@ -0,0 +1,393 @@
+import re
+import sys
+import json
+import sqlite3
+import argparse
+import pandas as pd
+from datetime import datetime
+
+from filterStates import has_index
+from ingest import table_exists
+from metrics import stage
+from weightedAgg import (
+    DEFAULT_WEIGHT,
+    add_means,
+    aggregate_sql,
+    decode_groups,
+    dictionary_source,
+    filter_clause,
+    quote,
+    weighted_aggregate,
+)
+
+# Settings and refresh times of every cube
+CUBE_META = "_rollup_cubes"
+
+# Per cube and PERIOD, the source row count and content signature it was
+# built from
+CUBE_PERIODS = "_rollup_periods"
+
+DIMENSIONS = ["STATE", "DISTRICT", "REGION_TYPE", "year", "month", "PERIOD"]
+
+# Numeric columns of the source matching these become cube measures
+MEASURE_PATTERNS = ["TOT_INC", "TOT_EXP", "M_EXP_", "SAVING"]
+
+NUMERIC_TYPES = ("INT", "INTEGER", "REAL", "FLOAT", "NUM", "NUMERIC")
+
+
+def cube_name(source):
+    return f"{source}_cube"
+
+
+def measure_columns(conn, source, patterns=MEASURE_PATTERNS):
+    # Numeric source columns matching any pattern, in table order
+    return [
+        name
+        for _, name, declared, *_ in conn.execute(f"PRAGMA table_info({quote(source)})")
+        if declared.upper() in NUMERIC_TYPES
+        and any(re.search(pattern, name) for pattern in patterns)
+    ]
+
+
+def load_cube_meta(conn, cube):
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {CUBE_META} (
+        cube TEXT PRIMARY KEY,
+        source TEXT,
+        weight TEXT,
+        dimensions TEXT,
+        measures TEXT,
+        refreshed_at TEXT
+    )
+    """)
+    row = conn.execute(
+        f"SELECT source, weight, dimensions, measures FROM {CUBE_META} WHERE cube = ?",
+        (cube,),
+    ).fetchone()
+    if row is None or not table_exists(conn, cube):
+        return None
+    return {
+        "source": row[0],
+        "weight": row[1],
+        "dimensions": json.loads(row[2]),
+        "measures": json.loads(row[3]),
+    }
+
+
+def save_cube_meta(conn, cube, source, weight, dimensions, measures):
+    conn.execute(
+        f"INSERT OR REPLACE INTO {CUBE_META} VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            cube,
+            source,
+            weight,
+            json.dumps(dimensions),
+            json.dumps(measures),
+            datetime.now().isoformat(timespec="seconds"),
+        ),
+    )
+
+
+def load_cube_periods(conn, cube):
+    # {PERIOD: (rows, signature)} as of the cube's last refresh
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {CUBE_PERIODS} (
+        cube TEXT,
+        PERIOD INTEGER,
+        rows INTEGER,
+        signature TEXT,
+        PRIMARY KEY (cube, PERIOD)
+    )
+    """)
+    return {
+        period: (rows, signature)
+        for period, rows, signature in conn.execute(
+            f"SELECT PERIOD, rows, signature FROM {CUBE_PERIODS} WHERE cube = ?",
+            (cube,),
+        )
+    }
+
+
+def period_row_counts(conn, source):
+    # Rows per PERIOD, answered from the PERIOD index without reading the
+    # table, so the check stays cheap however much history there is
+    return dict(
+        conn.execute(f"SELECT PERIOD, COUNT(*) FROM {quote(source)} GROUP BY PERIOD")
+    )
+
+
+def period_signatures(conn, source, measures, weight, periods):
+    # Per PERIOD, everything the cube's cells add up to: row count, weight
+    # total and each measure's weighted sum, weight and count, as text
+    # rounded to 12 significant digits so summation order does not matter
+    if not periods:
+        return {}
+    placeholders = ", ".join(["?" for _ in periods])
+    clause, params = filter_clause(
+        conn, source, weight, where=f"PERIOD IN ({placeholders})", params=periods
+    )
+    totals = aggregate_sql(conn, source, measures, weight, ["PERIOD"], clause, params)
+    return {
+        int(row[0]): " ".join(
+            "null" if pd.isna(value) else f"{float(value):.12g}" for value in row[1:]
+        )
+        for row in totals.itertuples(index=False, name=None)
+    }
+
+
+def save_cube_periods(conn, cube, periods, row_counts, signatures):
+    # Record what the given periods were checked or built against
+    placeholders = ", ".join(["?" for _ in periods])
+    conn.execute(
+        f"DELETE FROM {CUBE_PERIODS} WHERE cube = ? AND PERIOD IN ({placeholders})",
+        [cube] + list(periods),
+    )
+    conn.executemany(
+        f"INSERT INTO {CUBE_PERIODS} VALUES (?, ?, ?, ?)",
+        [
+            (cube, period, row_counts[period], signatures.get(period))
+            for period in periods
+            if period in row_counts
+        ],
+    )
+
+
+def create_cube_table(conn, cube, dimensions, measures):
+    columns = [quote(d) for d in dimensions]
+    columns += ["n INTEGER", "weight_sum REAL"]
+    for m in measures:
+        columns += [
+            f"{quote(m + '_sum')} REAL",
+            f"{quote(m + '_weight')} REAL",
+            f"{quote(m + '_n')} INTEGER",
+        ]
+    conn.execute(f"DROP TABLE IF EXISTS {quote(cube)}")
+    load_cube_periods(conn, cube)
+    conn.execute(f"DELETE FROM {CUBE_PERIODS} WHERE cube = ?", (cube,))
+    conn.execute(f"CREATE TABLE {quote(cube)} ({', '.join(columns)})")
+    conn.execute(f"CREATE INDEX idx_{cube}_PERIOD ON {quote(cube)} (PERIOD)")
+    if "STATE" in dimensions:
+        conn.execute(f"CREATE INDEX idx_{cube}_STATE ON {quote(cube)} (STATE, PERIOD)")
+
+
+def candidate_periods(row_counts, built, since=None):
+    # Periods that may need (re)aggregating: new ones, ones whose row count
+    # changed, ones gone from the source (so their cells get deleted), and
+    # with since every period from there on. Same-size rewrites of a period
+    # are only seen through since, which the pipeline passes from the join.
+    return sorted(
+        period
+        for period in set(row_counts) | set(built)
+        if row_counts.get(period) != built.get(period, (None, None))[0]
+        or (since is not None and period >= int(since))
+    )
+
+
+def stale_periods(candidates, signatures, built):
+    # The candidates whose content differs from what the cube was built from
+    return [
+        period
+        for period in candidates
+        if signatures.get(period) != built.get(period, (None, None))[1]
+    ]
+
+
+def refresh_cube(
+    db_path,
+    source="filteredStates",
+    measures=None,
+    weight=DEFAULT_WEIGHT,
+    dimensions=DIMENSIONS,
+    since=None,
+    rebuild=False,
+):
+    # Materialise weighted sums and counts of the measures per
+    # (state, district, region_type, year, month, PERIOD) cell into
+    # <source>_cube, recomputing only stale periods. The cube is rebuilt
+    # from scratch when asked, or when its weight, dimensions or measures
+    # change. measures defaults to the columns matching MEASURE_PATTERNS.
+    cube = cube_name(source)
+    conn = sqlite3.connect(db_path)
+    try:
+        with stage(f"rollup.{source}", outputs=[db_path]) as record:
+            existing = [row[1] for row in conn.execute(f"PRAGMA table_info({source})")]
+            missing = [d for d in dimensions if d not in existing]
+            if missing:
+                print(f"Dimensions not in '{source}', skipped: {', '.join(missing)}")
+            dimensions = [d for d in dimensions if d in existing]
+            if "PERIOD" not in dimensions:
+                raise ValueError(f"'{source}' has no PERIOD column to roll up by")
+            measures = list(measures or measure_columns(conn, source))
+
+            meta = load_cube_meta(conn, cube)
+            if (
+                rebuild
+                or meta is None
+                or (meta["weight"], meta["dimensions"], meta["measures"])
+                != (weight, dimensions, measures)
+            ):
+                print(f"Building cube '{cube}' with {len(measures)} measures")
+                create_cube_table(conn, cube, dimensions, measures)
+            if not has_index(conn.cursor(), source, ["PERIOD"]):
+                conn.execute(
+                    f"CREATE INDEX idx_{source}_PERIOD ON {quote(source)} (PERIOD)"
+                )
+            conn.commit()
+
+            built = load_cube_periods(conn, cube)
+            row_counts = period_row_counts(conn, source)
+            candidates = candidate_periods(row_counts, built, since)
+            signatures = period_signatures(conn, source, measures, weight, candidates)
+            periods = stale_periods(candidates, signatures, built)
+            record["periods"] = len(periods)
+            if not periods:
+                if candidates:
+                    save_cube_periods(conn, cube, candidates, row_counts, signatures)
+                    conn.commit()
+                print(f"Cube '{cube}' is up to date")
+                return cube
+
+            conn.execute("BEGIN TRANSACTION")
+            placeholders = ", ".join(["?" for _ in periods])
+            conn.execute(
+                f"DELETE FROM {quote(cube)} WHERE PERIOD IN ({placeholders})", periods
+            )
+            clause, params = filter_clause(
+                conn,
+                source,
+                weight,
+                where=f"PERIOD IN ({placeholders})",
+                params=periods,
+            )
+            cells = aggregate_sql(
+                conn, source, measures, weight, dimensions, clause, params
+            )
+            conn.executemany(
+                f"INSERT INTO {quote(cube)} "
+                f"({', '.join(quote(col) for col in cells.columns)}) "
+                f"VALUES ({', '.join(['?' for _ in cells.columns])})",
+                cells.astype(object)
+                .where(cells.notna(), None)
+                .itertuples(index=False, name=None),
+            )
+            save_cube_periods(conn, cube, candidates, row_counts, signatures)
+            save_cube_meta(conn, cube, source, weight, dimensions, measures)
+            conn.commit()
+
+            record["rows"] = int(cells["n"].sum()) if len(cells) else 0
+            record["cells"] = len(cells)
+            print(
+                f"Cube '{cube}': {len(cells)} cells for {len(periods)} periods "
+                f"({periods[0]}..{periods[-1]})"
+            )
+    finally:
+        conn.close()
+    return cube
+
+
+def cube_covers(meta, measures, by, weight):
+    return (
+        meta is not None
+        and meta["weight"] == weight
+        and all(col in meta["dimensions"] for col in by)
+        and all(m in meta["measures"] for m in measures)
+    )
+
+
+def query_cube(
+    db_path,
+    source="filteredStates",
+    measures=("TOT_INC",),
+    by=("STATE",),
+    weight=DEFAULT_WEIGHT,
+    states=None,
+    periods=None,
+    quantiles=(),
+):
+    # Weighted sums, means and counts in the same layout as
+    # weightedAgg.weighted_aggregate. Answered by re-summing the cube's
+    # cells when it holds the measures, grouping and weight; quantiles,
+    # which cannot be rolled up, and anything else go to the source table.
+    # periods is an optional inclusive (first, last) yyyymm range.
+    measures = list(measures)
+    by = list(by)
+    where = None
+    if periods is not None:
+        where = f"PERIOD BETWEEN {int(periods[0])} AND {int(periods[1])}"
+
+    conn = sqlite3.connect(db_path)
+    try:
+        meta = load_cube_meta(conn, cube_name(source))
+        if quantiles or not cube_covers(meta, measures, by, weight):
+            meta = None
+        else:
+            dict_source = dictionary_source(conn, source)
+            clause, params = filter_clause(
+                conn, dict_source, None, states=states, where=where
+            )
+            sums = ["n", "weight_sum"] + [
+                f"{m}_{part}" for m in measures for part in ("sum", "weight", "n")
+            ]
+            selects = [quote(col) for col in by] + [
+                f"SUM({quote(col)}) AS {quote(col)}" for col in sums
+            ]
+            group_by = f"GROUP BY {', '.join(quote(col) for col in by)}" if by else ""
+            result = pd.read_sql_query(
+                f"SELECT {', '.join(selects)} FROM {quote(cube_name(source))} "
+                f"{clause} {group_by}",
+                conn,
+                params=params,
+            )
+            add_means(result, measures)
+            result = decode_groups(conn, result, by, dict_source)
+    finally:
+        conn.close()
+
+    if meta is None:
+        print(f"Cube cannot answer this query; aggregating '{source}'")
+        return weighted_aggregate(
+            db_path, source, measures, weight, by, quantiles, states=states, where=where
+        )
+    return result.sort_values(by, ignore_index=True) if by else result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Refresh or query the weighted rollup cube of a joined table"
+    )
+    parser.add_argument("command", choices=["refresh", "query"])
+    parser.add_argument("--db", default="ladli.db")
+    parser.add_argument("--source", default="filteredStates")
+    parser.add_argument("--weight", default=DEFAULT_WEIGHT)
+    parser.add_argument("--measures", nargs="*", default=None)
+    parser.add_argument("--by", nargs="*", default=["STATE"])
+    parser.add_argument("--states", nargs="*", default=None)
+    parser.add_argument("--periods", nargs=2, type=int, default=None)
+    parser.add_argument("--since", type=int, default=None, help="refresh from yyyymm")
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "refresh":
+        refresh_cube(
+            args.db,
+            args.source,
+            args.measures,
+            args.weight,
+            since=args.since,
+            rebuild=args.rebuild,
+        )
+    else:
+        result = query_cube(
+            args.db,
+            args.source,
+            args.measures or ["TOT_INC"],
+            args.by,
+            args.weight,
+            states=args.states,
+            periods=args.periods,
+        )
+        result.to_csv(sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()
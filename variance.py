@@ -0,0 +1,381 @@
+import os
+import sys
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from metrics import stage
+from weightedAgg import (
+    DEFAULT_BY,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_WEIGHT,
+    decode_groups,
+    dictionary_source,
+    filter_clause,
+    iter_sql_chunks,
+    quote,
+)
+
+DEFAULT_REPLICATES = 200
+DEFAULT_SEED = 0
+
+# Result columns per group and measure: n, weight_sum, total (sum of w*m)
+# and mean (total / sum of w where m is present), each with its standard
+# error, and a percentile interval of the mean from the replicates. The
+# variance is scale * sum over replicates of (replicate - full sample)^2.
+
+
+def key_ids(df, columns, mapping):
+    # Integer ids of the rows' keys, numbered as first seen across chunks
+    local_ids, uniques = pd.MultiIndex.from_frame(df[columns]).factorize()
+    lookup = np.array(
+        [mapping.setdefault(key, len(mapping)) for key in uniques], dtype=np.int64
+    )
+    return lookup[local_ids]
+
+
+def write_arrays(
+    conn,
+    table,
+    measures,
+    weight,
+    by,
+    clause,
+    params,
+    array_dir,
+    design_columns,
+    replicate_columns=(),
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    # Stream the rows into .npy files the workers memory-map: weight,
+    # group ids, measures (NaN as 0) and their presence, PSU ids and any
+    # replicate weights. Measures and replicates are stored one per row so
+    # each is contiguous. Returns the group keys and the PSU keys.
+    count = f"SELECT COUNT(*) FROM {quote(table)} {clause}"
+    n = conn.execute(count, params).fetchone()[0]
+
+    def create(name, shape, dtype):
+        path = os.path.join(array_dir, f"{name}.npy")
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    arrays = {
+        "weight": create("weight", (n,), np.float64),
+        "group": create("group", (n,), np.int64),
+        "values": create("values", (len(measures), n), np.float64),
+        "present": create("present", (len(measures), n), np.bool_),
+    }
+    if design_columns:
+        arrays["psu"] = create("psu", (n,), np.int64)
+    if replicate_columns:
+        arrays["replicates"] = create(
+            "replicates", (len(replicate_columns), n), np.float64
+        )
+
+    groups = {}
+    psus = {}
+    columns = list(
+        dict.fromkeys(
+            list(by) + [weight] + list(measures) + design_columns + replicate_columns
+        )
+    )
+    start = 0
+    for df in iter_sql_chunks(conn, table, columns, clause, params, chunk_size):
+        end = start + len(df)
+        arrays["weight"][start:end] = df[weight].to_numpy(dtype=np.float64)
+        if by:
+            arrays["group"][start:end] = key_ids(df, by, groups)
+        else:
+            groups.setdefault((), 0)
+            arrays["group"][start:end] = 0
+        for j, m in enumerate(measures):
+            x = df[m].to_numpy(dtype=np.float64, na_value=np.nan)
+            present = ~np.isnan(x)
+            arrays["values"][j, start:end] = np.where(present, x, 0.0)
+            arrays["present"][j, start:end] = present
+        if design_columns:
+            arrays["psu"][start:end] = key_ids(df, design_columns, psus)
+        for j, col in enumerate(replicate_columns):
+            arrays["replicates"][j, start:end] = df[col].to_numpy(
+                dtype=np.float64, na_value=0.0
+            )
+        start = end
+
+    for values in arrays.values():
+        values.flush()
+    return list(groups), list(psus)
+
+
+def sort_psus_by_stratum(array_dir, psu_keys):
+    # Renumber PSUs so each stratum's are contiguous, and return the number
+    # of PSUs per stratum in that order. psu_keys are (STRATUM, PSU_ID).
+    order = sorted(range(len(psu_keys)), key=lambda i: psu_keys[i])
+    renumber = np.empty(len(psu_keys), dtype=np.int64)
+    renumber[order] = np.arange(len(psu_keys))
+    psu = np.load(os.path.join(array_dir, "psu.npy"), mmap_mode="r+")
+    psu[:] = renumber[psu]
+    psu.flush()
+    strata = pd.factorize(pd.Series([psu_keys[i][0] for i in order]))[0]
+    return np.bincount(strata)
+
+
+def load_arrays(array_dir):
+    # Read-only memory maps: every worker shares the page cache instead of
+    # holding its own copy of the columns
+    return {
+        name[:-4]: np.load(os.path.join(array_dir, name), mmap_mode="r")
+        for name in os.listdir(array_dir)
+        if name.endswith(".npy")
+    }
+
+
+def estimates(arrays, weights, n_groups):
+    # Totals then means of every measure per group, as one flat vector
+    ids = arrays["group"]
+    totals = []
+    means = []
+    for j in range(arrays["values"].shape[0]):
+        total = np.bincount(
+            ids, weights=weights * arrays["values"][j], minlength=n_groups
+        )
+        weight = np.bincount(
+            ids, weights=weights * arrays["present"][j], minlength=n_groups
+        )
+        totals.append(total)
+        means.append(total / np.where(weight != 0, weight, np.nan))
+    return np.concatenate(totals + means)
+
+
+def rao_wu_multipliers(rng, stratum_sizes):
+    # Rescaled bootstrap (Rao and Wu, 1988): in a stratum of n PSUs draw
+    # n - 1 with replacement; a PSU drawn k times gets k * n / (n - 1).
+    # Strata with a single PSU keep their weights and add no variance.
+    offsets = np.concatenate([[0], np.cumsum(stratum_sizes)[:-1]])
+    draws = np.repeat(np.arange(len(stratum_sizes)), np.maximum(stratum_sizes - 1, 0))
+    picked = offsets[draws] + rng.integers(0, stratum_sizes[draws])
+    counts = np.bincount(picked, minlength=stratum_sizes.sum())
+    sizes = np.repeat(stratum_sizes, stratum_sizes)
+    return np.where(sizes > 1, counts * sizes / np.maximum(sizes - 1, 1), 1.0)
+
+
+def run_replicates(array_dir, n_groups, replicates, stratum_sizes=None):
+    # Runs in a worker process. replicates are (index, SeedSequence) pairs
+    # for the bootstrap, or (index, None) to use replicate weight column
+    # index. Seeds are per replicate, so results do not depend on how
+    # replicates are split between workers.
+    arrays = load_arrays(array_dir)
+    results = []
+    for index, seed in replicates:
+        if seed is None:
+            weights = np.asarray(arrays["replicates"][index])
+        else:
+            multipliers = rao_wu_multipliers(np.random.default_rng(seed), stratum_sizes)
+            weights = arrays["weight"] * multipliers[arrays["psu"]]
+        results.append((index, estimates(arrays, weights, n_groups)))
+    return results
+
+
+def batches(items, n_batches):
+    size = max(1, -(-len(items) // n_batches))
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def replicate_variance(
+    db_path,
+    table="filteredStates",
+    measures=("TOT_INC",),
+    weight=DEFAULT_WEIGHT,
+    by=DEFAULT_BY,
+    states=None,
+    where=None,
+    params=(),
+    method="bootstrap",
+    replicates=DEFAULT_REPLICATES,
+    strata="STRATUM",
+    psu="PSU_ID",
+    replicate_columns=None,
+    scale=None,
+    seed=DEFAULT_SEED,
+    workers=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    array_dir=None,
+):
+    # Weighted totals and means per group with replicate standard errors.
+    # method="bootstrap" resamples PSUs within strata (Rao-Wu) for the
+    # given number of replicates; method="replicate" uses the weight
+    # columns in replicate_columns as published. scale defaults to
+    # 1 / replicates. The columns are written once to memory-mapped .npy
+    # files under array_dir (a temporary directory by default) and the
+    # replicates run on a pool of workers, in batches.
+    measures = list(measures)
+    by = list(by)
+    if method == "bootstrap":
+        design_columns, replicate_columns = [strata, psu], []
+    elif method == "replicate":
+        if not replicate_columns:
+            raise ValueError("method='replicate' needs replicate_columns")
+        design_columns, replicate_columns = [], list(replicate_columns)
+        replicates = len(replicate_columns)
+    else:
+        raise ValueError(f"method must be 'bootstrap' or 'replicate', not {method!r}")
+    scale = 1 / replicates if scale is None else scale
+    workers = workers or os.cpu_count() or 1
+
+    conn = sqlite3.connect(db_path)
+    array_root = tempfile.mkdtemp(prefix="variance_", dir=array_dir)
+    try:
+        with stage(
+            f"variance.{table}", measures=measures, by=by, method=method
+        ) as record:
+            dict_source = dictionary_source(conn, table)
+            conditions = [f"{quote(col)} IS NOT NULL" for col in design_columns]
+            if where:
+                conditions.append(f"({where})")
+            clause, params = filter_clause(
+                conn, dict_source, weight, states, " AND ".join(conditions), params
+            )
+            group_keys, psu_keys = write_arrays(
+                conn,
+                table,
+                measures,
+                weight,
+                by,
+                clause,
+                params,
+                array_root,
+                design_columns,
+                replicate_columns,
+                chunk_size,
+            )
+            n_groups = len(group_keys)
+
+            stratum_sizes = None
+            if method == "bootstrap":
+                stratum_sizes = sort_psus_by_stratum(array_root, psu_keys)
+                single = int((stratum_sizes == 1).sum())
+                print(
+                    f"{len(psu_keys)} PSUs in {len(stratum_sizes)} strata"
+                    + (f" ({single} with a single PSU)" if single else "")
+                )
+                children = np.random.SeedSequence(seed).spawn(replicates)
+                tasks = list(enumerate(children))
+            else:
+                tasks = [(i, None) for i in range(replicates)]
+
+            arrays = load_arrays(array_root)
+            full = estimates(arrays, np.asarray(arrays["weight"]), n_groups)
+            counts = np.bincount(arrays["group"], minlength=n_groups)
+            weight_sums = np.bincount(
+                arrays["group"], weights=arrays["weight"], minlength=n_groups
+            )
+            del arrays
+
+            results = np.empty((replicates, len(full)))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(
+                        run_replicates, array_root, n_groups, batch, stratum_sizes
+                    )
+                    for batch in batches(tasks, workers * 4)
+                ]
+                with tqdm(total=replicates, desc="Replicates") as progress:
+                    for future in as_completed(futures):
+                        batch = future.result()
+                        for index, values in batch:
+                            results[index] = values
+                        progress.update(len(batch))
+
+            variance = scale * np.nansum((results - full) ** 2, axis=0)
+            se = np.sqrt(variance)
+            ci_low, ci_high = np.nanpercentile(results, [2.5, 97.5], axis=0)
+
+            n_measures = len(measures)
+            result = []
+            for j, m in enumerate(measures):
+                total = slice(j * n_groups, (j + 1) * n_groups)
+                mean = slice(
+                    (n_measures + j) * n_groups, (n_measures + j + 1) * n_groups
+                )
+                frame = pd.DataFrame(group_keys, columns=by)
+                frame["measure"] = m
+                frame["n"] = counts
+                frame["weight_sum"] = weight_sums
+                frame["total"] = full[total]
+                frame["total_se"] = se[total]
+                frame["mean"] = full[mean]
+                frame["mean_se"] = se[mean]
+                frame["mean_ci_low"] = ci_low[mean]
+                frame["mean_ci_high"] = ci_high[mean]
+                result.append(frame)
+            result = pd.concat(result, ignore_index=True)
+            result["replicates"] = replicates
+
+            result = decode_groups(conn, result, by, dict_source)
+            result = result.sort_values(["measure"] + by, ignore_index=True)
+            record["rows"] = int(counts.sum())
+            record["groups"] = n_groups
+            record["replicates"] = replicates
+            record["workers"] = workers
+    finally:
+        conn.close()
+        shutil.rmtree(array_root, ignore_errors=True)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Bootstrap or replicate-weight standard errors of weighted "
+        "totals and means by group"
+    )
+    parser.add_argument("--db", default="ladli.db")
+    parser.add_argument("--table", default="filteredStates")
+    parser.add_argument("--measures", nargs="+", default=["TOT_INC"])
+    parser.add_argument("--weight", default=DEFAULT_WEIGHT)
+    parser.add_argument("--by", nargs="*", default=["STATE"])
+    parser.add_argument("--states", nargs="*", default=None)
+    parser.add_argument("--where", default=None, help="extra SQL condition")
+    parser.add_argument("--method", choices=["bootstrap", "replicate"])
+    parser.add_argument("--replicates", type=int, default=DEFAULT_REPLICATES)
+    parser.add_argument("--strata", default="STRATUM")
+    parser.add_argument("--psu", default="PSU_ID")
+    parser.add_argument(
+        "--replicate-columns", nargs="*", default=None, help="replicate weights"
+    )
+    parser.add_argument("--scale", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--array-dir", default=None, help="where to memory-map")
+    parser.add_argument("--output", default=None, help="CSV file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    result = replicate_variance(
+        args.db,
+        args.table,
+        args.measures,
+        args.weight,
+        args.by,
+        states=args.states,
+        where=args.where,
+        method=args.method or ("replicate" if args.replicate_columns else "bootstrap"),
+        replicates=args.replicates,
+        strata=args.strata,
+        psu=args.psu,
+        replicate_columns=args.replicate_columns,
+        scale=args.scale,
+        seed=args.seed,
+        workers=args.workers,
+        array_dir=args.array_dir,
+    )
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"{len(result)} estimates written to '{args.output}'")
+    else:
+        result.to_csv(sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()
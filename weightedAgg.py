@@ -0,0 +1,374 @@
+import sys
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+from ingest import dict_table, dictionary_source, encoded_columns, encoded_values
+from metrics import stage
+
+DEFAULT_BY = ["STATE", "DISTRICT", "REGION_TYPE", "PERIOD"]
+DEFAULT_WEIGHT = "HH_WGT_MS"
+DEFAULT_CHUNK_SIZE = 200000
+
+# Result columns per measure m: m_sum (sum of w*m), m_weight (sum of w
+# where m is present), m_mean (m_sum / m_weight), m_n (rows with m present)
+# and m_q<pct> for each requested quantile. Every group also gets n (rows)
+# and weight_sum (sum of w). Rows without a weight are left out.
+
+
+def quote(column):
+    return f'"{column}"'
+
+
+def filter_clause(conn, table, weight, states=None, where=None, params=()):
+    # WHERE clause and parameters shared by every query of an aggregation.
+    # states are matched on STATE, through its codes when it is encoded.
+    # weight=None leaves out the weight IS NOT NULL condition.
+    conditions = [f"{quote(weight)} IS NOT NULL"] if weight else []
+    if where:
+        conditions.append(f"({where})")
+    params = list(params)
+    if states is not None:
+        codes = encoded_values(conn, table, "STATE", states)
+        conditions.append(f"STATE IN ({', '.join(['?' for _ in codes])})")
+        params += codes
+    if not conditions:
+        return "", params
+    return f"WHERE {' AND '.join(conditions)}", params
+
+
+def aggregate_sql(conn, table, measures, weight, by, clause, params):
+    # Sums, means and counts computed by SQLite in one GROUP BY pass; only
+    # one row per group comes back to Python
+    selects = [quote(col) for col in by]
+    selects += ["COUNT(*) AS n", f"SUM({quote(weight)}) AS weight_sum"]
+    for m in measures:
+        selects += [
+            f"SUM({quote(weight)} * {quote(m)}) AS {quote(m + '_sum')}",
+            f"SUM(CASE WHEN {quote(m)} IS NOT NULL THEN {quote(weight)} END) "
+            f"AS {quote(m + '_weight')}",
+            f"COUNT({quote(m)}) AS {quote(m + '_n')}",
+        ]
+    group_by = f"GROUP BY {', '.join(quote(col) for col in by)}" if by else ""
+    query = f"SELECT {', '.join(selects)} FROM {quote(table)} {clause} {group_by}"
+    return pd.read_sql_query(query, conn, params=params)
+
+
+def iter_sql_chunks(conn, table, columns, clause, params, chunk_size):
+    # DataFrames of chunk_size rows, fetched with fetchmany so the table is
+    # never held in memory at once
+    cursor = conn.cursor()
+    cursor.arraysize = chunk_size
+    cursor.execute(
+        f"SELECT {', '.join(quote(col) for col in columns)} "
+        f"FROM {quote(table)} {clause}",
+        params,
+    )
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        yield pd.DataFrame.from_records(rows, columns=columns)
+
+
+def iter_parquet_chunks(root, dataset, columns, states=None, years=None, months=None):
+    # Record batches of a parquetStore dataset, with the same partition and
+    # STATE pruning as parquetStore.read_dataset
+    import pyarrow.dataset as ds
+
+    import parquetStore
+
+    data = parquetStore.open_dataset(root, dataset)
+    condition = None
+    for c in [
+        ds.field("year").isin([int(y) for y in years]) if years else None,
+        (
+            ds.field("month").isin([parquetStore.month_number(m) for m in months])
+            if months
+            else None
+        ),
+        ds.field("STATE").isin(list(states)) if states else None,
+    ]:
+        if c is not None:
+            condition = c if condition is None else condition & c
+    for batch in data.to_batches(columns=columns, filter=condition):
+        yield batch.to_pandas()
+
+
+def aggregate_chunks(chunks, measures, weight, by):
+    # The same sums and counts as aggregate_sql, accumulated with
+    # np.bincount over group ids. Group keys are numbered as they are first
+    # seen; the accumulators grow with the number of groups, not rows.
+    groups = {}
+    sums = {}
+
+    def add(name, ids, values, n_groups):
+        total = np.bincount(ids, weights=values, minlength=n_groups)
+        current = sums.get(name)
+        if current is None:
+            sums[name] = total
+        else:
+            if len(current) < n_groups:
+                current = np.pad(current, (0, n_groups - len(current)))
+            current += total
+            sums[name] = current
+
+    for df in chunks:
+        df = df[df[weight].notna()]
+        if df.empty:
+            continue
+        if by:
+            keys = pd.MultiIndex.from_frame(df[by])
+            local_ids, uniques = keys.factorize()
+            mapping = np.array(
+                [groups.setdefault(key, len(groups)) for key in uniques],
+                dtype=np.int64,
+            )
+            ids = mapping[local_ids]
+        else:
+            groups.setdefault((), 0)
+            ids = np.zeros(len(df), dtype=np.int64)
+        n_groups = len(groups)
+
+        w = df[weight].to_numpy(dtype=np.float64)
+        add("n", ids, None, n_groups)
+        add("weight_sum", ids, w, n_groups)
+        for m in measures:
+            x = df[m].to_numpy(dtype=np.float64, na_value=np.nan)
+            present = ~np.isnan(x)
+            add(f"{m}_sum", ids, np.where(present, w * x, 0.0), n_groups)
+            add(f"{m}_weight", ids, np.where(present, w, 0.0), n_groups)
+            add(f"{m}_n", ids, present.astype(np.float64), n_groups)
+
+    n_groups = len(groups)
+    result = pd.DataFrame(list(groups), columns=by)
+    counts = ["n"] + [f"{m}_n" for m in measures]
+    for name in ["n", "weight_sum"] + [
+        f"{m}_{part}" for m in measures for part in ("sum", "weight", "n")
+    ]:
+        values = sums.get(name, np.zeros(n_groups))
+        values = np.pad(values, (0, n_groups - len(values)))
+        result[name] = values.astype(np.int64) if name in counts else values
+    return result
+
+
+def add_means(result, measures):
+    # m_mean = m_sum / m_weight, missing where no row had a weight
+    for m in measures:
+        weights = result[f"{m}_weight"]
+        result[f"{m}_mean"] = result[f"{m}_sum"] / weights.where(weights != 0)
+    return result
+
+
+def weighted_quantiles_sql(
+    conn, table, measure, weight, by, quantiles, clause, params, totals, chunk_size
+):
+    # Exact weighted quantiles, streamed: SQLite sorts the rows by group
+    # and value (spilling to its temp store rather than to Python memory),
+    # and each group's running weight is compared with q * its total
+    # weight, so only one chunk and one row per group are ever held.
+    # totals maps group key -> total weight of rows with the measure.
+    columns = list(by) + [measure, weight]
+    order = ", ".join(quote(col) for col in columns[:-1])
+    clause = f"{clause} AND {quote(measure)} IS NOT NULL"
+    cursor = conn.cursor()
+    cursor.arraysize = chunk_size
+    cursor.execute(
+        f"SELECT {', '.join(quote(col) for col in columns)} "
+        f"FROM {quote(table)} {clause} ORDER BY {order}",
+        params,
+    )
+
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    found = {}
+    carry = {}
+    last = {}
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        chunk = pd.DataFrame.from_records(rows, columns=columns)
+        if by:
+            codes, uniques = pd.MultiIndex.from_frame(chunk[by]).factorize()
+            keys = list(uniques)
+        else:
+            codes, keys = np.zeros(len(chunk), dtype=np.int64), [()]
+        # Rows are sorted by group, so each group is one contiguous run
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+        ends = np.append(starts[1:], len(chunk))
+        values = chunk[measure].to_numpy(dtype=np.float64)
+        weights = chunk[weight].to_numpy(dtype=np.float64)
+        for start, end in zip(starts, ends):
+            key = keys[codes[start]]
+            if key not in totals:
+                continue
+            cumulative = carry.get(key, 0.0) + np.cumsum(weights[start:end])
+            carry[key] = cumulative[-1]
+            positions = np.searchsorted(cumulative, quantiles * totals[key])
+            hits = found.setdefault(key, np.full(len(quantiles), np.nan))
+            for i, position in enumerate(positions):
+                if np.isnan(hits[i]) and position < end - start:
+                    hits[i] = values[start + position]
+            last[key] = values[end - 1]
+
+    # Rounding can leave q = 1 a hair above the running total
+    for key, hits in found.items():
+        hits[np.isnan(hits)] = last[key]
+    return found
+
+
+def weighted_aggregate_parquet(
+    root,
+    dataset,
+    measures=("TOT_INC",),
+    weight=DEFAULT_WEIGHT,
+    by=("STATE", "DISTRICT", "REGION_TYPE", "year", "month"),
+    states=None,
+    years=None,
+    months=None,
+):
+    # Sums, means and counts over a parquetStore dataset, one record batch
+    # at a time; the hive year/month keys stand in for PERIOD
+    measures = list(measures)
+    by = list(by)
+    with stage(f"aggregate.parquet.{dataset}", measures=measures, by=by) as record:
+        chunks = iter_parquet_chunks(
+            root, dataset, by + [weight] + measures, states, years, months
+        )
+        result = aggregate_chunks(chunks, measures, weight, by)
+        add_means(result, measures)
+        record["rows"] = int(result["n"].sum()) if len(result) else 0
+        record["groups"] = len(result)
+    return result.sort_values(by, ignore_index=True) if by else result
+
+
+def quantile_column(measure, q):
+    return f"{measure}_q{round(q * 100, 2):g}"
+
+
+def decode_groups(conn, result, by, dict_source):
+    # Replace dictionary codes in the group columns by their text values
+    for col in by:
+        if col in encoded_columns(conn, dict_source):
+            lookup = dict(
+                conn.execute(f"SELECT code, value FROM {dict_table(dict_source, col)}")
+            )
+            result[col] = result[col].map(lookup)
+    return result
+
+
+def weighted_aggregate(
+    db_path,
+    table="filteredStates",
+    measures=("TOT_INC",),
+    weight=DEFAULT_WEIGHT,
+    by=DEFAULT_BY,
+    quantiles=(),
+    states=None,
+    where=None,
+    params=(),
+    pushdown=True,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    dict_source=None,
+):
+    # Weighted sums, means, counts and quantiles of measures per group.
+    # With pushdown the sums and counts are a single SQL GROUP BY; without
+    # it the rows are streamed in chunks through the NumPy accumulators.
+    # where/params add a raw SQL condition; dict_source is the table whose
+    # dictionaries decode encoded group columns (see dictionary_source).
+    measures = list(measures)
+    by = list(by)
+    conn = sqlite3.connect(db_path)
+    try:
+        with stage(f"aggregate.{table}", measures=measures, by=by) as record:
+            dict_source = dict_source or dictionary_source(conn, table)
+
+            clause, params = filter_clause(
+                conn, dict_source, weight, states, where, params
+            )
+            if pushdown:
+                result = aggregate_sql(
+                    conn, table, measures, weight, by, clause, params
+                )
+            else:
+                chunks = iter_sql_chunks(
+                    conn, table, by + [weight] + measures, clause, params, chunk_size
+                )
+                result = aggregate_chunks(chunks, measures, weight, by)
+
+            add_means(result, measures)
+            for m in measures if quantiles else []:
+                keys = (
+                    list(result[by].itertuples(index=False, name=None))
+                    if by
+                    else [()] * len(result)
+                )
+                totals = dict(zip(keys, result[f"{m}_weight"].to_numpy()))
+                found = weighted_quantiles_sql(
+                    conn,
+                    table,
+                    m,
+                    weight,
+                    by,
+                    quantiles,
+                    clause,
+                    params,
+                    totals,
+                    chunk_size,
+                )
+                for i, q in enumerate(quantiles):
+                    result[quantile_column(m, q)] = [
+                        found[key][i] if key in found else np.nan for key in keys
+                    ]
+
+            result = decode_groups(conn, result, by, dict_source)
+            if by:
+                result = result.sort_values(by, ignore_index=True)
+            record["rows"] = int(result["n"].sum()) if len(result) else 0
+            record["groups"] = len(result)
+    finally:
+        conn.close()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Survey-weighted sums, means, counts and quantiles by group"
+    )
+    parser.add_argument("--db", default="ladli.db")
+    parser.add_argument("--table", default="filteredStates")
+    parser.add_argument("--measures", nargs="+", default=["TOT_INC"])
+    parser.add_argument("--weight", default=DEFAULT_WEIGHT)
+    parser.add_argument("--by", nargs="*", default=DEFAULT_BY)
+    parser.add_argument("--quantiles", nargs="*", type=float, default=[])
+    parser.add_argument("--states", nargs="*", default=None)
+    parser.add_argument("--where", default=None, help="extra SQL condition")
+    parser.add_argument(
+        "--no-pushdown", action="store_true", help="aggregate in NumPy chunks"
+    )
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--output", default=None, help="CSV file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    result = weighted_aggregate(
+        args.db,
+        args.table,
+        args.measures,
+        args.weight,
+        args.by,
+        args.quantiles,
+        states=args.states,
+        where=args.where,
+        pushdown=not args.no_pushdown,
+        chunk_size=args.chunk_size,
+    )
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"{len(result)} groups written to '{args.output}'")
+    else:
+        result.to_csv(sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()